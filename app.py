@@ -1,15 +1,165 @@
 import os
+import json
 from flask import (
     Flask,
     request,
     abort,
-    jsonify
+    jsonify,
+    Response,
+    current_app
 )
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import db, setup_db, Movie, Actor
-from auth import AuthError, requires_auth
+from models import db, setup_db, Movie, Actor, StatBucket, Change, Job
+from auth import AuthError, requires_auth, readable_resources, check_permissions
+from idempotency import idempotent
+from events import ChangeHub, event_stream, REPLAY_LIMIT
+from compression import setup_compression
+from batch import parse_subrequest, dispatch_subrequest, format_subresponse
+from shared_cache import setup_shared_cache, cached_response
+from row_cache import setup_row_cache
+from singleflight import coalesced
+from jobs import JOB_KINDS, job_permissions, job_payload_schema
+from casting import match_actors, MAX_AGE
+from group_commit import insert_row
+from schemas import (
+    validated,
+    validate,
+    movie_create,
+    movie_update,
+    actor_create,
+    actor_update
+)
+from health import Readiness
+from profiling import setup_profiling
+from audit import setup_audit_log
+from capture import setup_capture
+
+
+'''
+if_match_versions()
+    parses the If-Match request header into the row versions a conditional
+    UPDATE may match, returns None when the header is absent or "*"
+'''
+
+
+def if_match_versions():
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    return [int(tag) for tag in if_match.as_set() if tag.isdigit()]
+
+
+COUNT_MODES = ('auto', 'exact', 'estimate', 'none')
+COUNT_EXACT_MAX = 10000
+
+
+'''
+with_etag(response, version)
+    tags the response with the row version so clients can send it
+    back as If-Match on their next PATCH
+'''
+
+
+def with_etag(response, version):
+    response.set_etag(str(version))
+    return response
+
+
+'''
+list_response(key, array, **fields)
+    a {"success": true, key: array, ...fields} response around a JSON array
+    that is already serialized, such as Movie.page_json()
+'''
+
+
+def list_response(key, array, **fields):
+    members = ['"success": true', '{}: {}'.format(json.dumps(key), array)]
+    members.extend('{}: {}'.format(json.dumps(name), json.dumps(value)) for name, value in fields.items())
+    return current_app.response_class('{' + ', '.join(members) + '}\n', mimetype='application/json')
+
+
+'''
+int_arg(name, default)
+    reads a non-negative integer query parameter, default when it is absent
+    it should respond with a 400 error if it is not made of digits only,
+    request.args.get(type=int) would silently fall back to the default
+'''
+
+
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if not (value.isascii() and value.isdigit()):
+        abort(400)
+    return int(value)
+
+
+'''
+page_args()
+    reads the ?after=<id>&limit=<n>&count=<mode> list parameters
+    it should respond with a 400 error if one of them is malformed
+'''
+
+
+def page_args():
+    after = int_arg('after', 0)
+    limit = int_arg('limit')
+    count = request.args.get('count', 'auto')
+    if after < 0 or (limit is not None and not 0 < limit <= 1000) or count not in COUNT_MODES:
+        abort(400)
+    return after, limit, count
+
+
+'''
+list_page(model, key, after, limit, count)
+    the page of model rows after id `after` with the total number of rows
+    in the X-Total-Count header and the total field, as counted by count
+        exact: SELECT COUNT(*)
+        estimate: the summary counters kept by the write methods, see
+        CatalogueMixin.row_count, marked with X-Total-Count-Estimated
+        none: no total
+        auto (default): the page length when the page holds the whole
+        table, otherwise an estimate, counted exactly below COUNT_EXACT_MAX
+'''
+
+
+def list_page(model, key, after, limit, count):
+    array, length = model.page_json(after, limit)
+    if count == 'none':
+        return list_response(key, array)
+
+    estimated = False
+    if count == 'exact':
+        total = model.row_count()
+    elif count == 'auto' and after == 0 and (limit is None or length < limit):
+        total = length
+    else:
+        total = model.row_count(estimate=True)
+        estimated = count == 'estimate' or total >= current_app.config.get('COUNT_EXACT_MAX', COUNT_EXACT_MAX)
+        if not estimated:
+            total = model.row_count()
+
+    response = list_response(key, array, total=total)
+    response.headers['X-Total-Count'] = str(total)
+    if estimated:
+        response.headers['X-Total-Count-Estimated'] = 'true'
+    return response
+
+
+'''
+with_errors(body, error)
+    adds the field errors a schema check aborted with (see schemas.py)
+    to an error response body
+'''
+
+
+def with_errors(body, error):
+    if isinstance(getattr(error, 'description', None), list):
+        body['errors'] = error.description
+    return body
 
 
 def create_app(test_config=None):
@@ -18,6 +168,8 @@ def create_app(test_config=None):
     moment = Moment(app)
     app.secret_key = "mysecretkey"
     setup_db(app)
+    setup_shared_cache(app)
+    setup_row_cache(app)
 
     '''
     Set up CORS(Cross Origin Resource Sharing).
@@ -26,6 +178,24 @@ def create_app(test_config=None):
     '''
     CORS(app, resources={"/": {"origin": "*"}})
 
+    # one change log listener per process for every /events subscriber
+    change_hub = ChangeHub(app)
+
+    # gzip/brotli negotiated through Accept-Encoding
+    setup_compression(app)
+
+    # X-Profile header and 1 in N sampling, see profiling.py
+    setup_profiling(app)
+
+    # JSON line per request written by a background thread, see audit.py
+    setup_audit_log(app)
+
+    # TRAFFIC_CAPTURE_PATH records requests for benchmarks/replay.py
+    setup_capture(app)
+
+    # warm-up state for /readyz, gunicorn.conf.py warms each worker on boot
+    readiness = app.extensions['readiness'] = Readiness(app)
+
     '''
     CORS Headers. Use the after_request decorator
     to set Access-Control-Allow
@@ -33,7 +203,8 @@ def create_app(test_config=None):
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
-                            'Content-Type,Authorization,true')
+                            'Content-Type,Authorization,If-Match,Idempotency-Key,X-Profile,X-Profile-Output,true')
+        response.headers.add('Access-Control-Expose-Headers', 'ETag,Idempotent-Replayed,X-Total-Count,X-Total-Count-Estimated')
         response.headers.add('Access-Control-Allow-Methods',
                             'GET,PUT,PATCH,POST,DELETE,OPTIONS')
         return response
@@ -44,25 +215,63 @@ def create_app(test_config=None):
             'message': 'Casting Agency',
         })
 
+    # Health Routes
+    '''
+    GET /healthz
+        liveness probe, answers without touching the database
+    returns status code 200 and json {"success": True, "status": "alive"}
+    '''
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({
+            'success': True,
+            'status': 'alive',
+        }), 200
+
+    '''
+    GET /readyz
+        readiness probe, it should respond 200 only once this worker has
+        warmed up: opened its database connections, loaded the Auth0 JWKS,
+        prepared the hot queries and serialized a first response
+        a worker that is not warm yet runs the warm-up on the probe
+    returns status code 200 and json {"success": True, "checks": checks}
+        or status code 503 naming the checks that have not passed
+    '''
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        ready = readiness.warm_up() and readiness.ping()
+        return jsonify({
+            'success': ready,
+            'checks': dict(readiness.checks),
+        }), 200 if ready else 503
+
     # Movie Routes
     '''
     @Implement endpoint
     GET /movies
         it should require the 'get:movies' permission
-    returns status code 200 and json {"success": True, "movies": movies}
+        it should be served from the shared cache until a movie write commits
+        it should join the cached JSON fragment of each row
+        identical concurrent requests share one database load
+        it should return the movies after id `after` in id order, at most
+        limit of them (1 to 1000, all when omitted)
+        it should report the total number of movies as chosen by
+        ?count=exact|estimate|none, see list_page
+    returns status code 200 and json {"success": True, "movies": movies, "total": total}
         where movies is the list of movies
         or appropriate status code indicating reason for failure
     '''
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @coalesced('get:movies')
+    @cached_response('movies')
     def get_movies(jwt):
+        after, limit, count = page_args()
         try:
-            movies = Movie.query.all()
-            return jsonify({
-                'success': True,
-                'movies': [movie.format() for movie in movies]
-            }), 200
+            return list_page(Movie, 'movies', after, limit, count), 200
         except BaseException:
             abort(404)
 
@@ -79,22 +288,29 @@ def create_app(test_config=None):
 
     @app.route('/movies/<int:id>', methods=['GET'])
     @requires_auth('get:movies')
+    @coalesced('get:movies')
+    @cached_response('movies')
     def get_movie_by_specific_id(jwt, id):
         movie = Movie.query.get(id)
 
         if movie is None:
             abort(404)
         else:
-            return jsonify({
+            return with_etag(jsonify({
                 'success': True,
                 'movie': movie.format(),
-            }), 200
+            }), movie.version), 200
 
     '''
     @Implement endpoint
     POST /movies
         it should create a new row in the movie table
         it should require the 'post:movies' permission
+        it should respond with a 400 error if the body is not a JSON object
+        and with a 422 error listing the invalid fields, see schemas.py
+        it should replay the stored response for a repeated Idempotency-Key
+        it should share its commit with concurrent creates when
+        GROUP_COMMIT_ENABLED is set, see group_commit.py
     returns status code 200 and json {"success": True, "movie": movie}
         where movie is an array containing only the newly created movie
         or appropriate status code indicating reason for failure
@@ -102,22 +318,15 @@ def create_app(test_config=None):
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
-    def create_movie(jwt):
-        body = request.get_json()
-
-        if not('title' in body and 'release_date' in body):
-            abort(422)
-
-        title = body.get('title')
-        release_date = body .get('release_date')
-
+    @validated(movie_create)
+    @idempotent
+    def create_movie(jwt, body):
         try:
-            movie = Movie(title=title, release_date=release_date)
-            movie.insert()
+            movie = insert_row(Movie, body)
 
             return jsonify({
                 'success': True,
-                'movie': movie.format(),
+                'movie': Movie.format_row(movie),
             })
         except BaseException:
             abort(422)
@@ -129,6 +338,9 @@ def create_app(test_config=None):
         it should respond with a 404 error if <id> is not found
         it should update the corresponding row for <id>
         it should require the 'patch:movies' permission
+        it should validate the fields given like POST /movies
+        it should respond with a 412 error if the If-Match header does not
+        match the current row version (ETag)
     returns status code 200 and json {"success": True, "movie": movie}
         where movie an array containing only the updated movie
         or appropriate status code indicating reason for failure
@@ -136,31 +348,25 @@ def create_app(test_config=None):
 
     @app.route('/movies/<int:id>', methods=['PATCH'])
     @requires_auth('patch:movies')
-    def update_movie(jwt, id):
-        movie = Movie.query.get(id)
-        if movie:
-            try:
-                body = request.get_json()
-
-                title = body.get('title')
-                if title:
-                    movie .title = title
-
-                release_date = body.get('release_date')
-                if release_date:
-                    movie.release_date = release_date
-
-                movie.update()
-                return jsonify({
-                    'success': True,
-                    'movie': [movie.format()],
-                })
-
-            except BaseException:
-                abort(422)
-        else:
+    @validated(movie_update)
+    def update_movie(jwt, id, body):
+        versions = if_match_versions()
+        try:
+            movie = Movie.update_by_id(id, body, versions)
+        except BaseException:
+            abort(422)
+
+        if movie is None:
+            # only pay for the existence check when the UPDATE matched nothing
+            if versions is not None and Movie.exists(id):
+                abort(412)
             abort(404)
 
+        return with_etag(jsonify({
+            'success': True,
+            'movie': [Movie.format_row(movie)],
+        }), movie.version)
+
     '''
     @Implement endpoint
     DELETE /movies/<id>
@@ -176,42 +382,84 @@ def create_app(test_config=None):
     @app.route('/movies/<int:id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(jwt, id):
-        movie = Movie.query.filter(Movie.id == id).one_or_none()
-
-        if movie:
-            try:
-                movie.delete()
-                return jsonify({
-                    'success': True,
-                    'delete': id,
-                })
-            except BaseException:
-                abort(422)
-        else:
+        try:
+            movie = Movie.delete_by_id(id)
+        except BaseException:
+            abort(422)
+
+        if movie is None:
             abort(404)
 
+        return jsonify({
+            'success': True,
+            'delete': id,
+        })
+
     # Actor Routes
     '''
     @Implement endpoint
     GET /actors
         it should require the 'get:actors' permission
-    returns status code 200 and json {"success": True, "actors": actors}
+        it should be served from the shared cache until a actor write commits
+        it should join the cached JSON fragment of each row
+        identical concurrent requests share one database load
+        it should return the actors after id `after` in id order, at most
+        limit of them (1 to 1000, all when omitted)
+        it should report the total number of actors as chosen by
+        ?count=exact|estimate|none, see list_page
+    returns status code 200 and json {"success": True, "actors": actors, "total": total}
         where actors is the list of actors
         or appropriate status code indicating reason for failure
     '''
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @coalesced('get:actors')
+    @cached_response('actors')
     def get_actors(jwt):
+        after, limit, count = page_args()
         try:
-            actors = Actor.query.all()
-            return jsonify({
-                'success': True,
-                'actors': [actor.format() for actor in actors]
-            }), 200
+            return list_page(Actor, 'actors', after, limit, count), 200
         except BaseException:
             abort(404)
 
+    '''
+    GET /actors/match?gender=<gender>&age_min=<n>&age_max=<n>&exclude=<ids>&limit=<n>
+        it should require the 'get:actors' permission
+        it should return the actors of gender (any gender when omitted) aged
+        age_min (default 0) to age_max (default 130), leaving out the comma
+        separated actor ids in exclude, gender is matched exactly
+        it should rank actors by how close their age is to the middle of the
+        band, the younger first on a tie, and return at most limit of them
+        (default 20, max 100)
+        it should respond with a 400 error if a parameter is malformed
+    returns status code 200 and json {"success": True, "actors": actors, "total": total}
+        where total is the number of matching actors before the limit
+    '''
+
+    @app.route('/actors/match', methods=['GET'])
+    @requires_auth('get:actors')
+    @coalesced('get:actors')
+    @cached_response('actors')
+    def match_actors_for_role(jwt):
+        gender = request.args.get('gender') or None
+        age_min = int_arg('age_min', 0)
+        age_max = int_arg('age_max', MAX_AGE)
+        limit = int_arg('limit', 20)
+        exclude = request.args.get('exclude', '').split(',')
+        if not all(id.isascii() and id.isdigit() for id in exclude if id):
+            abort(400)
+        exclude = {int(id) for id in exclude if id}
+        if not 0 <= age_min <= age_max or not 0 < limit <= 100:
+            abort(400)
+
+        total, actors = match_actors(gender, age_min, age_max, exclude, limit)
+        return jsonify({
+            'success': True,
+            'actors': [actor.format() for actor in actors],
+            'total': total,
+        }), 200
+
     '''
     @Implement endpoint
     GET /actors/<id>
@@ -225,22 +473,29 @@ def create_app(test_config=None):
 
     @app.route('/actors/<int:id>', methods=['GET'])
     @requires_auth('get:actors')
+    @coalesced('get:actors')
+    @cached_response('actors')
     def get_actor_by_specific_id(jwt, id):
         actor = Actor.query.get(id)
 
         if actor is None:
             abort(404)
         else:
-            return jsonify({
+            return with_etag(jsonify({
                 'success': True,
                 'actor': actor.format(),
-            }), 200
+            }), actor.version), 200
 
     '''
     @Implement endpoint
     POST /actors
         it should create a new row in the actor table
         it should require the 'post:actors' permission
+        it should respond with a 400 error if the body is not a JSON object
+        and with a 422 error listing the invalid fields, see schemas.py
+        it should replay the stored response for a repeated Idempotency-Key
+        it should share its commit with concurrent creates when
+        GROUP_COMMIT_ENABLED is set, see group_commit.py
     returns status code 200 and json {"success": True, "actor": actor}
         where actor is an array containing only the newly created actor
         or appropriate status code indicating reason for failure
@@ -248,23 +503,15 @@ def create_app(test_config=None):
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
-    def create_actor(jwt):
-        body = request.get_json()
-
-        if not('name' in body and 'gender' in body and 'age' in body):
-            abort(422)
-
-        name = body.get('name')
-        gender = body .get('gender')
-        age = body .get('age')
-
+    @validated(actor_create)
+    @idempotent
+    def create_actor(jwt, body):
         try:
-            actor = Actor(name=name, gender=gender, age=age)
-            actor.insert()
+            actor = insert_row(Actor, body)
 
             return jsonify({
                 'success': True,
-                'actor': actor.format(),
+                'actor': Actor.format_row(actor),
             })
         except BaseException:
             abort(422)
@@ -276,6 +523,9 @@ def create_app(test_config=None):
         it should respond with a 404 error if <id> is not found
         it should update the corresponding row for <id>
         it should require the 'patch:actors' permission
+        it should validate the fields given like POST /actors
+        it should respond with a 412 error if the If-Match header does not
+        match the current row version (ETag)
     returns status code 200 and json {"success": True, "actor": actor}
         where movie an array containing only the updated actor
         or appropriate status code indicating reason for failure
@@ -283,35 +533,24 @@ def create_app(test_config=None):
 
     @app.route('/actors/<int:id>', methods=['PATCH'])
     @requires_auth('patch:actors')
-    def update_actor(jwt, id):
-        actor = Actor.query.get(id)
-        if actor:
-            try:
-                body = request.get_json()
-
-                name = body.get('name')
-                if name:
-                    actor.name = name
-
-                gender = body.get('gender')
-                if gender:
-                    actor.gender = gender
-
-                age = body.get('age')
-                if age:
-                    actor.age = age
-
-                actor.update()
-                return jsonify({
-                    'success': True,
-                    'actor': [actor.format()],
-                })
-
-            except BaseException:
-                abort(422)
-        else:
+    @validated(actor_update)
+    def update_actor(jwt, id, body):
+        versions = if_match_versions()
+        try:
+            actor = Actor.update_by_id(id, body, versions)
+        except BaseException:
+            abort(422)
+
+        if actor is None:
+            if versions is not None and Actor.exists(id):
+                abort(412)
             abort(404)
 
+        return with_etag(jsonify({
+            'success': True,
+            'actor': [Actor.format_row(actor)],
+        }), actor.version)
+
     '''
     @Implement delete endpoint
     DELETE /actors/<id>
@@ -327,20 +566,272 @@ def create_app(test_config=None):
     @app.route('/actors/<int:id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(jwt, id):
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
-
-        if actor:
-            try:
-                actor.delete()
-                return jsonify({
-                    'success': True,
-                    'delete': id,
-                })
-            except BaseException:
-                abort(422)
-        else:
+        try:
+            actor = Actor.delete_by_id(id)
+        except BaseException:
+            abort(422)
+
+        if actor is None:
             abort(404)
 
+        return jsonify({
+            'success': True,
+            'delete': id,
+        })
+
+    # Statistics Routes
+    '''
+    GET /stats/movies
+        it should require the 'get:movies' permission
+    returns status code 200 and json
+        {"success": True, "total": total, "release_year": {year: count}}
+        read from the stat_buckets summary table instead of the movies table
+    '''
+
+    @app.route('/stats/movies', methods=['GET'])
+    @requires_auth('get:movies')
+    @coalesced('get:movies')
+    @cached_response('movies')
+    def get_movie_stats(jwt):
+        summary = StatBucket.summary('movies')
+        release_years = summary.get('release_year', {})
+        return jsonify({
+            'success': True,
+            'total': sum(release_years.values()),
+            'release_year': release_years,
+        }), 200
+
+    '''
+    GET /stats/actors
+        it should require the 'get:actors' permission
+    returns status code 200 and json
+        {"success": True, "total": total, "gender": {gender: count},
+         "age": {"30-39": count}}
+        read from the stat_buckets summary table instead of the actors table
+    '''
+
+    @app.route('/stats/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    @coalesced('get:actors')
+    @cached_response('actors')
+    def get_actor_stats(jwt):
+        summary = StatBucket.summary('actors')
+        genders = summary.get('gender', {})
+        return jsonify({
+            'success': True,
+            'total': sum(genders.values()),
+            'gender': genders,
+            'age': summary.get('age', {}),
+        }), 200
+
+    # Change Feed Routes
+    '''
+    GET /changes?since=<cursor>&limit=<n>
+        it should require a valid token, only changes to resources the token
+        can read ('get:movies', 'get:actors') are returned
+        it should return at most limit changes (default 100, max 1000)
+        after the since cursor in commit log order, deletes are tombstones
+        with "data": null
+    returns status code 200 and json
+        {"success": True, "changes": changes, "next": cursor, "has_more": bool}
+        where next is the cursor to send as since on the following call
+    '''
+
+    @app.route('/changes', methods=['GET'])
+    @requires_auth()
+    def get_changes(jwt):
+        resources = readable_resources(jwt)
+        since = int_arg('since', 0)
+        limit = int_arg('limit', 100)
+        if not 0 < limit <= 1000:
+            abort(400)
+
+        # fetch one extra row to tell the client whether to keep paging
+        changes = Change.since(since, resources, limit + 1)
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        return jsonify({
+            'success': True,
+            'changes': [change.format() for change in changes],
+            'next': changes[-1].id if changes else since,
+            'has_more': has_more,
+        }), 200
+
+    # Event Stream Routes
+    '''
+    GET /events
+        it should require a valid token, checked once when the stream opens
+        only events for resources the token can read ('get:movies',
+        'get:actors') are pushed
+        it should replay changes after the Last-Event-ID header (or the
+        since query parameter) before streaming live events, a client more
+        than EVENTS_REPLAY_LIMIT changes behind gets those, then a resync event
+        and the end of the stream
+        it should respond with a 503 error once the worker already serves
+        EVENTS_MAX_STREAMS streams, so regular routes keep their threads
+    returns a text/event-stream of create, update and delete events whose
+        data is the change as returned by GET /changes, the stream ends when
+        the token expires and the client reconnects with a fresh token
+    '''
+
+    @app.route('/events', methods=['GET'])
+    @requires_auth()
+    def get_events(jwt):
+        resources = readable_resources(jwt)
+        last_id = request.headers.get('Last-Event-ID', request.args.get('since'))
+        if last_id is not None:
+            if not str(last_id).isdigit():
+                abort(400)
+            last_id = int(last_id)
+
+        limit = current_app.config.get('EVENTS_REPLAY_LIMIT', REPLAY_LIMIT)
+        subscription = change_hub.subscribe(resources)
+        if subscription is None:
+            abort(503)
+        try:
+            backlog = []
+            last_position = None
+            if last_id is not None:
+                last_position = Change.position_of(last_id)
+                changes = Change.since(last_id, resources, limit + 1)
+                backlog = [(change.position, change.format()) for change in changes]
+        except BaseException:
+            change_hub.unsubscribe(subscription)
+            raise
+        resync = len(backlog) > limit
+
+        # no app context is held while streaming, the connection goes back
+        # to the pool when this view returns
+        response = Response(
+            event_stream(subscription, backlog[:limit], last_position, jwt.get('exp'), resync),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        response.call_on_close(lambda: change_hub.unsubscribe(subscription))
+        return response
+
+    # Batch Routes
+    '''
+    POST /batch
+        takes json {"requests": [{"method": ..., "path": ..., "body": ...,
+        "headers": {"If-Match": ...}}, ...], "atomic": false}
+        it should require a valid token, verified once for the whole batch,
+        every sub-request still needs its own route permission
+        it should dispatch the sub-requests in order through the regular
+        view functions, at most BATCH_MAX_REQUESTS (25) of them
+        it should respond with a 400 error, before running any of them, if
+        one entry has an unsupported method, path, body or headers
+        with "atomic": true all writes share one transaction, the first
+        sub-request failing rolls every write back and stops the batch
+    returns status code 200 and json {"success": True, "responses": responses}
+        where responses holds {"status", "body", "etag"} per sub-request
+        or status code 422 with the responses up to the failing one when an
+        atomic batch was rolled back
+    '''
+
+    @app.route('/batch', methods=['POST'])
+    @requires_auth()
+    def batch(jwt):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('requests'), list):
+            abort(400)
+
+        subrequests = body['requests']
+        if not 0 < len(subrequests) <= app.config.get('BATCH_MAX_REQUESTS', 25):
+            abort(400)
+
+        # every entry is checked before the first one runs, a malformed
+        # entry must not abort a batch whose earlier writes have committed
+        parsed = [parse_subrequest(subrequest) for subrequest in subrequests]
+
+        atomic = bool(body.get('atomic', False))
+        authorization = request.headers['Authorization']
+        responses = []
+        try:
+            for subrequest in parsed:
+                response = dispatch_subrequest(app, subrequest, authorization, atomic)
+                responses.append(format_subresponse(response))
+                if atomic and response.status_code >= 400:
+                    db.session.rollback()
+                    return jsonify({
+                        'success': False,
+                        'error': 422,
+                        'message': 'unprocessable',
+                        'responses': responses,
+                    }), 422
+            if atomic:
+                db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            raise
+
+        return jsonify({
+            'success': True,
+            'responses': responses,
+        }), 200
+
+    # Job Routes
+    '''
+    POST /jobs
+        takes json {"kind": kind, "payload": {...}}
+        it should require a valid token holding every permission of the job
+        kind (see jobs.JOB_KINDS), e.g. 'post:actors' for import_actors
+        it should respond with a 400 error if the body is not a JSON object
+        and with a 422 error for an unknown kind or a payload that does not
+        match its schema, import rows are checked like POST bodies
+        the job is queued for the `python manage.py worker` processes
+    returns status code 202 and json {"success": True, "job": job}
+        and the job url in the Location header
+    '''
+
+    @app.route('/jobs', methods=['POST'])
+    @requires_auth()
+    def create_job(jwt):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        if body.get('kind') not in JOB_KINDS:
+            abort(422, [{'field': 'kind', 'message': 'must be one of ' + ', '.join(sorted(JOB_KINDS))}])
+
+        for permission in job_permissions(body['kind']):
+            check_permissions(permission, jwt)
+
+        # bulk rows are checked like single POST bodies before the job is queued
+        payload = body.get('payload') or {}
+        validate(job_payload_schema(body['kind']), payload, 'payload')
+
+        job = Job(kind=body['kind'], payload=payload, subject=jwt.get('sub'))
+        job.insert()
+        return jsonify({
+            'success': True,
+            'job': job.format(),
+        }), 202, {'Location': '/jobs/{}'.format(job.id)}
+
+    '''
+    GET /jobs/<id>
+        where <id> is the existing job id
+        it should require the permissions of the job kind
+        it should respond with a 404 error if <id> is not found
+    returns status code 200 and json {"success": True, "job": job}
+        where job holds status (queued, running, succeeded, failed),
+        progress (0-100), and result or error once finished
+    '''
+
+    @app.route('/jobs/<int:id>', methods=['GET'])
+    @requires_auth()
+    def get_job(jwt, id):
+        job = Job.query.get(id)
+        if job is None:
+            abort(404)
+
+        for permission in job_permissions(job.kind):
+            check_permissions(permission, jwt)
+
+        return jsonify({
+            'success': True,
+            'job': job.format(),
+        }), 200
+
     # Error Handling
 
     '''
@@ -349,11 +840,11 @@ def create_app(test_config=None):
     '''
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        return jsonify(with_errors({
             "success": False,
             "error": 400,
             "message": "bad request"
-        }), 400
+        }, error)), 400
 
     @app.errorhandler(404)
     def not_found(error):
@@ -363,13 +854,38 @@ def create_app(test_config=None):
             "message": "resource not found"
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        return jsonify(with_errors({
             "success": False,
             "error": 422,
             "message": "unprocessable"
-        }), 422
+        }, error)), 422
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        # same delay as the retry field of an event stream
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503, {'Retry-After': '3'}
 
     @app.errorhandler(500)
     def internal_server_error(error):
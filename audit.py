@@ -0,0 +1,228 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from queue import Queue, Empty, Full
+from flask import request, g
+
+logger = logging.getLogger(__name__)
+
+# in the app instance folder unless AUDIT_LOG_PATH is set
+DEFAULT_FILE = 'audit.log'
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_SECONDS = 1.0
+MAX_BYTES = 50 * 1024 * 1024
+BACKUPS = 5
+SAMPLE_READS = 10
+FLUSH_TIMEOUT = 5.0
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+'''
+AuditLog
+    structured access and audit log, one JSON line per request with the
+    JWT subject, method, route, path, view arguments, status and latency
+
+    record() never blocks the request thread, it puts the record on a
+    bounded queue that a daemon writer thread drains in batches of up to
+    AUDIT_LOG_BATCH_SIZE lines, written at least every
+    AUDIT_LOG_FLUSH_SECONDS, the thread starts with the first record so
+    each gunicorn worker has its own after the fork
+
+    under backpressure, once the queue is three quarters full, only one in
+    AUDIT_LOG_SAMPLE_READS reads is kept (sampled) while writes are all
+    kept, a record that finds the queue full is dropped, stats() reports
+    written, sampled, dropped and rotated counts, flush() waits, at most
+    FLUSH_TIMEOUT seconds, for the queued records to be written and runs
+    at exit
+
+    the file at AUDIT_LOG_PATH ("-" writes to stdout) is rotated once it
+    reaches AUDIT_LOG_MAX_BYTES keeping AUDIT_LOG_BACKUPS old files, every
+    worker appends to the same file and rotation takes a lock file so only
+    one of them shifts the backups, both are created private to the user
+    and never through a symlink
+
+    other JSON line logs reuse the writer with their own config prefix,
+    see capture.py
+'''
+
+
+class AuditLog(object):
+
+    def __init__(self, app, prefix, path):
+        config = app.config
+        config.setdefault(prefix + '_PATH', path)
+        config.setdefault(prefix + '_QUEUE_SIZE', QUEUE_SIZE)
+        config.setdefault(prefix + '_BATCH_SIZE', BATCH_SIZE)
+        config.setdefault(prefix + '_FLUSH_SECONDS', FLUSH_SECONDS)
+        config.setdefault(prefix + '_MAX_BYTES', MAX_BYTES)
+        config.setdefault(prefix + '_BACKUPS', BACKUPS)
+        config.setdefault(prefix + '_SAMPLE_READS', SAMPLE_READS)
+        self.path = config[prefix + '_PATH']
+        self.batch_size = config[prefix + '_BATCH_SIZE']
+        self.flush_seconds = config[prefix + '_FLUSH_SECONDS']
+        self.max_bytes = config[prefix + '_MAX_BYTES']
+        self.backups = config[prefix + '_BACKUPS']
+        self.sample_reads = config[prefix + '_SAMPLE_READS']
+        self.queue = Queue(config[prefix + '_QUEUE_SIZE'])
+        self.high_water = self.queue.maxsize * 3 // 4
+        self.lock = threading.Lock()
+        self.thread = None
+        self.file = None
+        self.reads = 0
+        self.counters = {'written': 0, 'sampled': 0, 'dropped': 0, 'rotated': 0}
+        atexit.register(self.flush)
+
+    def record(self, entry):
+        if self.queue.qsize() >= self.high_water and entry['method'] in READ_METHODS:
+            self.reads += 1
+            if self.reads % self.sample_reads:
+                self.counters['sampled'] += 1
+                return
+        try:
+            self.queue.put_nowait(entry)
+        except Full:
+            self.counters['dropped'] += 1
+            return
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='audit-log', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_seconds)]
+            except Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception:
+                logger.exception('audit log write failed, %s records lost', len(batch))
+                self.counters['dropped'] += len(batch)
+                self.close()
+            for _ in batch:
+                self.queue.task_done()
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        # waits for the writer to catch up, at exit and in tests
+        if self.thread is None or not self.thread.is_alive():
+            return False
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks, timeout)
+
+    def write(self, batch):
+        lines = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in batch)
+        if self.path == '-':
+            sys.stdout.write(lines)
+            sys.stdout.flush()
+        else:
+            if self.file is None or self.rotated_elsewhere():
+                self.reopen()
+            self.file.write(lines)
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self.rotate()
+        self.counters['written'] += len(batch)
+
+    def rotated_elsewhere(self):
+        # another worker may have moved the file away
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def rotate(self):
+        with open_private(self.path + '.lock') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.rotated_elsewhere() and os.path.getsize(self.path) >= self.max_bytes:
+                for n in range(self.backups - 1, 0, -1):
+                    if os.path.exists('{}.{}'.format(self.path, n)):
+                        os.replace('{}.{}'.format(self.path, n), '{}.{}'.format(self.path, n + 1))
+                if self.backups > 0:
+                    os.replace(self.path, self.path + '.1')
+                else:
+                    os.remove(self.path)
+                self.counters['rotated'] += 1
+        self.reopen()
+
+    def reopen(self):
+        self.close()
+        self.file = open_private(self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return dict(self.counters, queued=self.queue.qsize())
+
+
+def open_private(path):
+    # O_NOFOLLOW, a planted symlink must not redirect the log, and a file
+    # left readable by others is narrowed to the user
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    if os.fstat(fd).st_mode & 0o077:
+        os.fchmod(fd, 0o600)
+    return open(fd, 'a', encoding='utf-8')
+
+
+'''
+setup_audit_log(app)
+    records every request, including the sub-requests of POST /batch, to
+    the AuditLog in app.extensions['audit_log'], AUDIT_LOG_ENABLED = False
+    turns it off
+    AUDIT_LOG_PATH defaults to DEFAULT_FILE in the app instance folder,
+    created private to the user
+'''
+
+
+def setup_audit_log(app):
+    if not app.config.get('AUDIT_LOG_ENABLED', True):
+        return None
+    path = app.config.get('AUDIT_LOG_PATH', os.environ.get('AUDIT_LOG_PATH'))
+    if path is None:
+        os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+        path = os.path.join(app.instance_path, DEFAULT_FILE)
+    audit_log = app.extensions['audit_log'] = AuditLog(app, 'AUDIT_LOG', path)
+
+    @app.before_request
+    def start_timer():
+        # batch sub-requests share g with the batch, keep it on the request
+        request.environ['audit.started'] = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = request.environ.get('audit.started')
+        if started is None:
+            return response
+        verified = g.get('verified_jwt')
+        audit_log.record({
+            'time': datetime.utcnow().isoformat() + 'Z',
+            'sub': verified[1].get('sub') if verified is not None else None,
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule is not None else None,
+            'path': request.path,
+            'args': request.view_args or {},
+            'status': response.status_code,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 3),
+            'remote_addr': request.remote_addr,
+        })
+        return response
+
+    return audit_log
@@ -1,13 +1,25 @@
 import json
-from flask import request, _request_ctx_stack, abort
+from flask import request, _request_ctx_stack, abort, g
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 import os
+import time
+from shared_cache import cache, token_key
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 API_AUDIENCE = os.environ['AUTH0_API_AUDIENCE']
+# local key set for replays against a local instance, never set in production
+JWKS_PATH = os.environ.get('AUTH0_JWKS_PATH')
+# shared cache entries are keyed by the key set and audience they were
+# verified for, an instance trusting a local key set on the same host
+# never hands its keys or tokens to the others
+JWKS_SOURCE = os.path.abspath(JWKS_PATH) if JWKS_PATH else f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+JWKS_KEY = 'jwks:' + JWKS_SOURCE
+TOKEN_SCOPE = JWKS_SOURCE + ' ' + API_AUDIENCE
 ALGORITHMS = ['RS256']
+JWKS_CACHE_SECONDS = 60 * 60
+TOKEN_CACHE_SECONDS = 5 * 60
 
 # AuthError Exception
 '''
@@ -97,6 +109,25 @@ def check_permissions(permission, payload):
     return True
 
 
+'''
+readable_resources(payload)
+    returns the resources ('movies', 'actors') the payload may read
+    it should raise an AuthError if the payload can read none of them
+'''
+
+
+def readable_resources(payload):
+    permissions = payload.get('permissions', [])
+    resources = [resource for resource in ('movies', 'actors')
+                 if 'get:' + resource in permissions]
+    if not resources:
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+    return resources
+
+
 '''
 @TODO implement verify_decode_jwt(token) method
     @INPUTS
@@ -113,11 +144,34 @@ def check_permissions(permission, payload):
 '''
 
 
-def verify_decode_jwt(token):
-    # Get public key from Auth0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+def get_jwks(refresh=False):
+    # Get public keys from Auth0, shared by all workers for JWKS_CACHE_SECONDS
+    jwks = None if refresh else cache.get(JWKS_KEY)
+    if jwks is None:
+        if JWKS_PATH:
+            with open(JWKS_PATH) as jwks_file:
+                jwks = json.load(jwks_file)
+        else:
+            jsonurl = urlopen(JWKS_SOURCE)
+            jwks = json.loads(jsonurl.read())
+        cache.set(JWKS_KEY, jwks, JWKS_CACHE_SECONDS)
+    return jwks
+
+
+def find_rsa_key(jwks, kid):
+    for key in jwks['keys']:
+        if key['kid'] == kid:
+            return {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return {}
 
+
+def verify_decode_jwt(token):
     # Get data in header
     unverified_header = jwt.get_unverified_header(token)
 
@@ -128,17 +182,10 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    rsa_key = {}
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = find_rsa_key(get_jwks(), unverified_header['kid'])
+    if not rsa_key:
+        # the signing key may have been rotated since the keys were cached
+        rsa_key = find_rsa_key(get_jwks(refresh=True), unverified_header['kid'])
 
     # Verify the token
     if rsa_key:
@@ -176,6 +223,37 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+'''
+verified_payload(token)
+    verifies the token at most once per application context, so the
+    sub-requests POST /batch dispatches reuse the payload of the batch,
+    and at most once per host while it stays in the shared cache
+'''
+
+
+def verified_payload(token):
+    verified = g.get('verified_jwt')
+    if verified is not None and verified[0] == token:
+        return verified[1]
+
+    # tokens verified by any worker are kept until they expire, at most
+    # TOKEN_CACHE_SECONDS
+    key = token_key(token, TOKEN_SCOPE)
+    payload = cache.get(key)
+    if payload is None:
+        try:
+            payload = verify_decode_jwt(token)
+        except AuthError as err:
+            abort(401, err.error)
+
+        ttl = min(payload.get('exp', 0) - time.time(), TOKEN_CACHE_SECONDS)
+        if ttl > 0:
+            cache.set(key, payload, ttl)
+
+    g.verified_jwt = (token, payload)
+    return payload
+
+
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
@@ -183,8 +261,11 @@ def verify_decode_jwt(token):
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+    (through verified_payload)
     it should use the check_permissions method validate claims
     and check the requested permission
+    an empty permission only requires a valid token, routes serving
+    several resources filter by the payload permissions themselves
     return the decorator which passes the decoded payload
     to the decorated method
 '''
@@ -195,12 +276,10 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except AuthError as err:
-                abort(401, err.error)
+            payload = verified_payload(token)
 
-            check_permissions(permission, payload)
+            if permission:
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,85 @@
+from urllib.parse import urlsplit
+from flask import abort
+from models import db
+from shared_cache import SUBREQUEST_KEY
+
+BATCH_METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+UNBATCHABLE_PATHS = ('/batch', '/events', '/readyz', '/healthz')
+# headers a sub-request may set, Authorization always comes from the batch
+# Idempotency-Key is not forwarded, its bookkeeping commits on its own
+FORWARDED_HEADERS = ('If-Match',)
+
+'''
+parse_subrequest(subrequest)
+    validates one entry of the POST /batch "requests" list
+    it should abort with 400 if the method, path, body or headers are invalid
+    returns (method, path, query_string, body, headers)
+'''
+
+
+def parse_subrequest(subrequest):
+    if not isinstance(subrequest, dict):
+        abort(400)
+
+    method = str(subrequest.get('method', 'GET')).upper()
+    target = subrequest.get('path')
+    if method not in BATCH_METHODS or not isinstance(target, str) or not target.startswith('/'):
+        abort(400)
+
+    url = urlsplit(target)
+    if url.path.rstrip('/') in UNBATCHABLE_PATHS:
+        abort(400)
+
+    body = subrequest.get('body')
+    if body is not None and not isinstance(body, (dict, list)):
+        abort(400)
+
+    headers = subrequest.get('headers') or {}
+    if not isinstance(headers, dict):
+        abort(400)
+    headers = {name: str(value) for name, value in headers.items() if name in FORWARDED_HEADERS}
+
+    return method, url.path, url.query, body, headers
+
+
+'''
+dispatch_subrequest(app, parsed, authorization, atomic)
+    runs one sub-request, as returned by parse_subrequest(), through the regular view function, error handlers
+    and after_request hooks inside the current application context, so it
+    shares the database session and the verified token of the batch
+    in an atomic batch every write runs inside a SAVEPOINT, the view's own
+    commit only releases it and the batch commits or rolls back once
+    returns the flask response
+'''
+
+
+def dispatch_subrequest(app, parsed, authorization, atomic):
+    method, path, query_string, body, headers = parsed
+    headers = dict(headers, Authorization=authorization)
+
+    savepoint = None
+    if atomic and method != 'GET':
+        savepoint = db.session.begin_nested()
+
+    with app.test_request_context(path, method=method, query_string=query_string,
+                                  json=body, headers=headers,
+                                  environ_overrides={SUBREQUEST_KEY: True}):
+        response = app.full_dispatch_request()
+
+    # views that return without committing (replays, early aborts)
+    if savepoint is not None and savepoint.is_active:
+        if response.status_code < 400:
+            savepoint.commit()
+        else:
+            savepoint.rollback()
+    return response
+
+
+def format_subresponse(response):
+    formatted = {
+        'status': response.status_code,
+        'body': response.get_json(silent=True),
+    }
+    if 'ETag' in response.headers:
+        formatted['etag'] = response.headers['ETag']
+    return formatted
@@ -0,0 +1,115 @@
+"""Benchmark group commit for concurrent POST /actors
+
+Runs the same concurrent insert load with group commit disabled and enabled
+and reports the rows inserted per second and the commits they took.
+
+The database is a temporary SQLite file with an artificial latency per
+statement and per commit standing in for the network round trip and the
+WAL flush of PostgreSQL; token verification is replaced by a fixed payload
+so Auth0 is not involved.
+
+    python benchmarks/bench_group_commit.py --clients 64 --requests 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bench-group-commit-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(WORKDIR, 'bench.db'))
+os.environ.setdefault('SHARED_CACHE_PATH', os.path.join(WORKDIR, 'cache.sqlite3'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.invalid')
+os.environ.setdefault('AUTH0_API_AUDIENCE', 'casting-agency')
+
+from sqlalchemy import event  # noqa: E402
+
+import auth  # noqa: E402
+from app import create_app  # noqa: E402
+from models import db, db_drop_and_create_all  # noqa: E402
+from group_commit import group  # noqa: E402
+
+PAYLOAD = {'sub': 'bench', 'permissions': ['post:actors'], 'exp': time.time() + 3600}
+
+
+def run(app, clients, requests):
+    commits = []
+
+    def statement(conn, cursor, statement, parameters, context, executemany):
+        time.sleep(app.config['BENCH_DB_LATENCY'])
+
+    def commit(conn):
+        commits.append(1)
+        time.sleep(app.config['BENCH_COMMIT_LATENCY'])
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', statement)
+        event.listen(db.engine, 'commit', commit)
+
+    start_barrier = threading.Barrier(clients)
+    latencies = []
+
+    def client(n):
+        test_client = app.test_client()
+        start_barrier.wait()
+        for i in range(requests):
+            actor = {'name': 'Actor {}-{}'.format(n, i), 'gender': 'Female', 'age': 20 + i % 60}
+            started = time.perf_counter()
+            res = test_client.post('/actors', json=actor, headers={'Authorization': 'Bearer bench'})
+            latencies.append(time.perf_counter() - started)
+            assert res.status_code == 200, res.status_code
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        event.remove(db.engine, 'before_cursor_execute', statement)
+        event.remove(db.engine, 'commit', commit)
+
+    latencies.sort()
+    return {
+        'rows': len(latencies),
+        'commits': len(commits),
+        'rows_per_sec': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--db-latency-ms', type=float, default=0.5)
+    parser.add_argument('--commit-latency-ms', type=float, default=2.0)
+    parser.add_argument('--window-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    auth.verify_decode_jwt = lambda token: PAYLOAD
+    app = create_app()
+    app.config['BENCH_DB_LATENCY'] = args.db_latency_ms / 1000
+    app.config['BENCH_COMMIT_LATENCY'] = args.commit_latency_ms / 1000
+    app.config['GROUP_COMMIT_WINDOW_MS'] = args.window_ms
+    with app.app_context():
+        db_drop_and_create_all()
+
+    print('{:<12}{:>10}{:>10}{:>12}{:>10}{:>10}'.format(
+        'mode', 'rows', 'commits', 'rows/s', 'p50 ms', 'p99 ms'))
+    for enabled in (False, True):
+        app.config['GROUP_COMMIT_ENABLED'] = enabled
+        result = run(app, args.clients, args.requests)
+        print('{:<12}{rows:>10}{commits:>10}{rows_per_sec:>12.1f}{p50_ms:>10.2f}{p99_ms:>10.2f}'.format(
+            'grouped' if enabled else 'baseline', **result))
+    print('group commit counters: {}'.format(group.stats()))
+
+
+if __name__ == '__main__':
+    main()
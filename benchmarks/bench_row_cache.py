@@ -0,0 +1,89 @@
+"""Benchmark list serialization with and without the row fragment cache
+
+Loads --rows actors into a temporary SQLite database and times building the
+GET /actors body the previous way (ORM objects, format() and jsonify) against
+Actor.page_json() with a cold and a warm fragment cache. The response cache
+and the HTTP layer are left out so only loading and serialization are timed.
+
+    python benchmarks/bench_row_cache.py --rows 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bench-row-cache-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(WORKDIR, 'bench.db'))
+os.environ.setdefault('SHARED_CACHE_PATH', os.path.join(WORKDIR, 'cache.sqlite3'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.invalid')
+os.environ.setdefault('AUTH0_API_AUDIENCE', 'casting-agency')
+
+from flask import jsonify  # noqa: E402
+
+from app import create_app, list_response  # noqa: E402
+from models import db, db_drop_and_create_all, Actor  # noqa: E402
+from row_cache import rows  # noqa: E402
+
+
+def baseline():
+    actors = Actor.query.all()
+    body = jsonify({
+        'success': True,
+        'actors': [actor.format() for actor in actors]
+    }).get_data()
+    db.session.remove()
+    return body
+
+
+def fragments():
+    body = list_response('actors', Actor.page_json()[0]).get_data()
+    db.session.remove()
+    return body
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.config['ROW_CACHE_SIZE'] = max(args.rows, app.config['ROW_CACHE_SIZE'])
+    rows.resize(app.config['ROW_CACHE_SIZE'])
+    with app.test_request_context():
+        db_drop_and_create_all()
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': 'Actor {}'.format(n), 'gender': 'Female' if n % 2 else 'Male',
+             'age': 20 + n % 60, 'version': 1}
+            for n in range(args.rows)
+        ])
+        db.session.commit()
+
+        assert len(baseline()) > 0
+        rows.clear()
+        cold = timed(lambda: (rows.clear(), fragments()), args.repeat)
+        warm = timed(fragments, args.repeat)
+        base = timed(baseline, args.repeat)
+
+    print('{:<24}{:>12}{:>12}'.format('mode ({} rows)'.format(args.rows), 'best ms', 'speedup'))
+    for mode, elapsed in (('format + jsonify', base), ('fragments, cold cache', cold),
+                          ('fragments, warm cache', warm)):
+        print('{:<24}{:>12.1f}{:>11.1f}x'.format(mode, elapsed * 1000, base / elapsed))
+    print('row cache: {}'.format(rows.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark request coalescing for GET /movies/<id>
+
+Runs the same concurrent client load against one hot movie with single-flight
+disabled and enabled and reports the database queries issued for it.
+
+The database is a temporary SQLite file with an artificial per-statement
+latency standing in for the network round trip to PostgreSQL; token
+verification is replaced by a fixed payload so Auth0 is not involved.
+The shared response cache is disabled so every request reaches the view.
+
+    python benchmarks/bench_singleflight.py --clients 64 --requests 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bench-singleflight-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(WORKDIR, 'bench.db'))
+os.environ.setdefault('SHARED_CACHE_PATH', os.path.join(WORKDIR, 'cache.sqlite3'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.invalid')
+os.environ.setdefault('AUTH0_API_AUDIENCE', 'casting-agency')
+
+from sqlalchemy import event  # noqa: E402
+
+import auth  # noqa: E402
+from app import create_app  # noqa: E402
+from models import db, db_drop_and_create_all, Movie  # noqa: E402
+from singleflight import flight  # noqa: E402
+
+PAYLOAD = {'sub': 'bench', 'permissions': ['get:movies'], 'exp': time.time() + 3600}
+
+
+def run(app, clients, requests):
+    queries = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM movies' in statement:
+            queries.append(1)
+        time.sleep(app.config['BENCH_DB_LATENCY'])
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count)
+
+    start_barrier = threading.Barrier(clients)
+    latencies = []
+
+    def client():
+        test_client = app.test_client()
+        start_barrier.wait()
+        for _ in range(requests):
+            started = time.perf_counter()
+            res = test_client.get('/movies/1', headers={'Authorization': 'Bearer bench'})
+            latencies.append(time.perf_counter() - started)
+            assert res.status_code == 200, res.status_code
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'elapsed': elapsed,
+        'db_queries': len(queries),
+        'db_qps': len(queries) / elapsed,
+        'req_per_sec': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--db-latency-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    auth.verify_decode_jwt = lambda token: PAYLOAD
+    app = create_app()
+    app.config['RESPONSE_CACHE_TTL'] = 0
+    app.config['BENCH_DB_LATENCY'] = args.db_latency_ms / 1000
+    with app.app_context():
+        db_drop_and_create_all()
+        Movie(title='Parasite', release_date='2019-05-21').insert()
+
+    print('{:<12}{:>10}{:>10}{:>12}{:>12}{:>10}{:>10}'.format(
+        'mode', 'requests', 'db', 'db qps', 'req/s', 'p50 ms', 'p99 ms'))
+    for enabled in (False, True):
+        app.config['SINGLEFLIGHT_ENABLED'] = enabled
+        result = run(app, args.clients, args.requests)
+        print('{:<12}{requests:>10}{db_queries:>10}{db_qps:>12.1f}{req_per_sec:>12.1f}'
+              '{p50_ms:>10.2f}{p99_ms:>10.2f}'.format('coalesced' if enabled else 'baseline', **result))
+    print('single-flight counters: {}'.format(flight.stats()))
+
+
+if __name__ == '__main__':
+    main()
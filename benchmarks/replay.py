@@ -0,0 +1,300 @@
+"""Replay captured traffic against a local instance and compare builds
+
+Requests captured with TRAFFIC_CAPTURE_PATH set (see capture.py) are sent
+again in their recorded order and timing, --speed times faster, or as fast
+as --concurrency allows with --speed 0. Bodies are rebuilt from their shapes
+with a fixed seed, so every replay of a capture sends the same bytes, and
+each captured subject gets a token signed by a local key with the
+permissions it had. The instance must trust that key, start it with
+AUTH0_JWKS_PATH pointing at the key set this tool writes, and restore the
+same database before each run so both builds see the same rows.
+
+    python benchmarks/replay.py keys replay-keys
+    AUTH0_JWKS_PATH=replay-keys/jwks.json gunicorn app:app
+    python benchmarks/replay.py run capture.jsonl --keys replay-keys --output a.json
+    # restore the database, start the other build, then
+    python benchmarks/replay.py run capture.jsonl --keys replay-keys --output b.json
+    python benchmarks/replay.py compare a.json b.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import string
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import rsa
+from jose import jwk, jwt
+
+TOKEN_SECONDS = 6 * 60 * 60
+INVALID_TOKEN = 'replay-invalid-token'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def load(paths):
+    records = []
+    for path in paths:
+        with open(path) as capture_file:
+            records.extend(json.loads(line) for line in capture_file if line.strip())
+    records.sort(key=lambda record: record['time'])
+    return records
+
+
+def unshape(value, rng):
+    # the inverse of capture.shape(), strings get random letters
+    if isinstance(value, list):
+        return [unshape(item, rng) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '$str' in value:
+        return ''.join(rng.choice(string.ascii_letters) for _ in range(value['$str']))
+    if '$date' in value:
+        return value['$date']
+    if '$list' in value:
+        return [unshape(value['$item'], rng) for _ in range(value['$list'])]
+    return {key: unshape(item, rng) for key, item in value.items()}
+
+
+def write_keys(directory):
+    public_key, private_key = rsa.newkeys(2048)
+    kid = uuid.uuid4().hex
+    key = jwk.construct(public_key.save_pkcs1().decode('ascii'), 'RS256').to_dict()
+    key.update({'kid': kid, 'use': 'sig'})
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'key.pem'), 'wb') as key_file:
+        key_file.write(private_key.save_pkcs1())
+    with open(os.path.join(directory, 'jwks.json'), 'w') as jwks_file:
+        json.dump({'keys': [key]}, jwks_file)
+    print('wrote {0}/key.pem and {0}/jwks.json, start the instance with '
+          'AUTH0_JWKS_PATH={0}/jwks.json'.format(directory))
+
+
+class Tokens(object):
+    """One token per captured subject and permissions, signed by the key
+    in directory for the instance's AUTH0_DOMAIN and AUTH0_API_AUDIENCE
+    """
+
+    def __init__(self, directory, domain, audience):
+        with open(os.path.join(directory, 'key.pem')) as key_file:
+            self.key = key_file.read()
+        with open(os.path.join(directory, 'jwks.json')) as jwks_file:
+            self.kid = json.load(jwks_file)['keys'][0]['kid']
+        self.domain = domain
+        self.audience = audience
+        self.tokens = {}
+
+    def header(self, auth):
+        if auth is None:
+            return None
+        if auth['permissions'] is None:
+            return 'Bearer ' + INVALID_TOKEN
+        key = (auth['sub'], tuple(auth['permissions']))
+        if key not in self.tokens:
+            now = int(time.time())
+            self.tokens[key] = 'Bearer ' + jwt.encode({
+                'iss': 'https://{}/'.format(self.domain),
+                'aud': self.audience,
+                'sub': 'replay|{}'.format(auth['sub']),
+                'permissions': auth['permissions'],
+                'iat': now,
+                'exp': now + TOKEN_SECONDS,
+            }, self.key, algorithm='RS256', headers={'kid': self.kid})
+        return self.tokens[key]
+
+
+def prepare(records, tokens, seed):
+    requests = []
+    for index, record in enumerate(records):
+        headers = dict(record['headers'])
+        authorization = tokens.header(record['auth'])
+        if authorization is not None:
+            headers['Authorization'] = authorization
+        body = None
+        if record['body'] is not None:
+            # retries under one Idempotency-Key get the same body again
+            rng = random.Random('{}:{}'.format(seed, headers.get('Idempotency-Key', index)))
+            if isinstance(record['body'], dict) and '$bytes' in record['body']:
+                body = bytes(rng.getrandbits(8) for _ in range(record['body']['$bytes']))
+            else:
+                body = json.dumps(unshape(record['body'], rng)).encode('utf-8')
+        target = record['path'] + ('?' + record['query'] if record['query'] else '')
+        route = '{} {}'.format(record['method'], record['route'] or record['path'])
+        requests.append((record, route, target, headers, body))
+    return requests
+
+
+class Client(threading.local):
+    """A keep-alive connection per replay thread, reopened once when the
+    server closed it
+    """
+
+    def __init__(self, target):
+        self.url = urlsplit(target)
+        self.connection = None
+
+    def send(self, method, target, headers, body):
+        for attempt in (1, 2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+            try:
+                self.connection.request(method, target, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status, len(data)
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def replay(requests, target, speed, concurrency):
+    client = Client(target)
+    results = []
+    first = requests[0][0]['time'] if requests else 0
+
+    def send(request, due):
+        record, route, target, headers, body = request
+        started = time.perf_counter()
+        try:
+            status, size = client.send(record['method'], target, headers, body)
+        except Exception:
+            status, size = None, 0
+        results.append({
+            'route': route,
+            'status': status,
+            'expected_status': record['status'],
+            'latency': time.perf_counter() - started,
+            'lag': started - due,
+            'bytes': size,
+        })
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        for request in requests:
+            due = started
+            if speed > 0:
+                due = started + (request[0]['time'] - first) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, request, due)
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    def stats(entries):
+        latencies = sorted(entry['latency'] * 1000 for entry in entries)
+        statuses = {}
+        for entry in entries:
+            statuses[str(entry['status'])] = statuses.get(str(entry['status']), 0) + 1
+        return {
+            'requests': len(entries),
+            'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+            'statuses': statuses,
+            'status_mismatches': sum(1 for entry in entries if entry['status'] != entry['expected_status']),
+        }
+
+    routes = {}
+    for entry in results:
+        routes.setdefault(entry['route'], []).append(entry)
+    lags = sorted(entry['lag'] * 1000 for entry in results)
+    summary = stats(results)
+    summary.update({
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else None,
+        'p99_lag_ms': percentile(lags, 0.99),
+        'routes': {route: stats(entries) for route, entries in sorted(routes.items())},
+    })
+    return summary
+
+
+def change(a, b):
+    if a is None or b is None or a == 0:
+        return ''
+    return '{:+.1f}%'.format((b - a) / a * 100)
+
+
+def compare(a, b):
+    print('{:<36}{:>9}{:>10}{:>10}{:>9}{:>10}{:>10}{:>9}'.format(
+        'route', 'requests', 'a p50', 'b p50', 'change', 'a p99', 'b p99', 'change'))
+    rows = [('all', a, b)] + [(route, a['routes'][route], b['routes'].get(route))
+                              for route in a['routes']]
+    for route, stats_a, stats_b in rows:
+        if stats_b is None:
+            print('{:<36}{:>9}  missing from b'.format(route, stats_a['requests']))
+            continue
+        print('{:<36}{:>9}{:>10.2f}{:>10.2f}{:>9}{:>10.2f}{:>10.2f}{:>9}'.format(
+            route, stats_a['requests'],
+            stats_a['p50_ms'], stats_b['p50_ms'], change(stats_a['p50_ms'], stats_b['p50_ms']),
+            stats_a['p99_ms'], stats_b['p99_ms'], change(stats_a['p99_ms'], stats_b['p99_ms'])))
+        if stats_a['statuses'] != stats_b['statuses']:
+            print('    statuses differ: a {} b {}'.format(stats_a['statuses'], stats_b['statuses']))
+    print('throughput: a {:.1f} req/s, b {:.1f} req/s ({})'.format(
+        a['throughput'], b['throughput'], change(a['throughput'], b['throughput'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    keys = commands.add_parser('keys', help='write a signing key and its JWKS')
+    keys.add_argument('directory')
+
+    run = commands.add_parser('run', help='replay captures and write a summary')
+    run.add_argument('captures', nargs='+')
+    run.add_argument('--target', default='http://127.0.0.1:8000')
+    run.add_argument('--keys', required=True, help='directory written by the keys command')
+    run.add_argument('--domain', default=os.environ.get('AUTH0_DOMAIN'))
+    run.add_argument('--audience', default=os.environ.get('AUTH0_API_AUDIENCE'))
+    run.add_argument('--speed', type=float, default=1.0, help='1 for recorded timing, 0 for no pauses')
+    run.add_argument('--concurrency', type=int, default=32)
+    run.add_argument('--seed', default='replay')
+    run.add_argument('--output', required=True)
+
+    diff = commands.add_parser('compare', help='compare the summaries of two runs')
+    diff.add_argument('a')
+    diff.add_argument('b')
+    args = parser.parse_args()
+
+    if args.command == 'keys':
+        write_keys(args.directory)
+    elif args.command == 'run':
+        if not args.domain or not args.audience:
+            sys.exit('set AUTH0_DOMAIN and AUTH0_API_AUDIENCE as for the instance, or pass --domain and --audience')
+        requests = prepare(load(args.captures), Tokens(args.keys, args.domain, args.audience), args.seed)
+        if not requests:
+            sys.exit('no requests in the captures')
+        results, elapsed = replay(requests, args.target, args.speed, args.concurrency)
+        summary = summarize(results, elapsed)
+        with open(args.output, 'w') as output:
+            json.dump(summary, output, indent=2)
+        print('{requests} requests in {elapsed:.2f}s, {throughput:.1f} req/s, p50 {p50_ms:.2f} ms, '
+              'p99 {p99_ms:.2f} ms, {status_mismatches} statuses differ from the capture'.format(**summary))
+    else:
+        with open(args.a) as a, open(args.b) as b:
+            compare(json.load(a), json.load(b))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from flask import request, g, current_app
+from audit import AuditLog
+from batch import SUBREQUEST_KEY
+
+LIST_ITEMS = 10
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}([ T][0-9:.]+)?(Z|[+-]\d{2}:?\d{2})?$')
+KEPT_HEADERS = ('Accept-Encoding', 'Content-Type', 'If-Match')
+# string fields that pick a code path rather than describe anyone: job
+# kinds, batch sub-request methods and paths, actor genders
+KEPT_FIELDS = ('kind', 'method', 'path', 'gender')
+
+'''
+shape(value)
+    the body of a captured request without its personal data, strings are
+    replaced by {"$str": length} except those of KEPT_FIELDS and dates,
+    kept as {"$date": value} so a replayed date still parses, lists longer
+    than LIST_ITEMS become {"$list": length, "$item": shape of the first
+    item}, object keys, numbers, booleans and nulls are kept as sent
+    benchmarks/replay.py turns a shape back into a body of the same size
+'''
+
+
+def shape(value, field=None):
+    if isinstance(value, dict):
+        return {key: shape(item, key) for key, item in value.items()}
+    if isinstance(value, list):
+        if len(value) > LIST_ITEMS:
+            return {'$list': len(value), '$item': shape(value[0], field)}
+        return [shape(item, field) for item in value]
+    if isinstance(value, str) and field not in KEPT_FIELDS:
+        if DATE_PATTERN.match(value):
+            return {'$date': value}
+        return {'$str': len(value)}
+    return value
+
+
+def hashed(value):
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+
+
+'''
+capture_record(response)
+    the captured form of the current request, without its Authorization
+    header or token, auth is null without a verified token, otherwise the
+    hashed subject and the permissions the replay signs a token for
+    Idempotency-Key is hashed so repeated keys stay repeated
+'''
+
+
+def capture_record(response):
+    headers = {name: request.headers[name] for name in KEPT_HEADERS if name in request.headers}
+    if 'Idempotency-Key' in request.headers:
+        headers['Idempotency-Key'] = hashed(request.headers['Idempotency-Key'])
+
+    auth = None
+    verified = g.get('verified_jwt')
+    if verified is not None:
+        auth = {
+            'sub': hashed(verified[1].get('sub', '')),
+            'permissions': sorted(verified[1].get('permissions', [])),
+        }
+    elif 'Authorization' in request.headers:
+        auth = {'sub': None, 'permissions': None}
+
+    body = None
+    if request.content_length:
+        json_body = request.get_json(silent=True)
+        body = shape(json_body) if json_body is not None else {'$bytes': request.content_length}
+
+    return {
+        'time': request.environ['capture.started'],
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule is not None else None,
+        'path': request.path,
+        'query': request.query_string.decode('latin-1'),
+        'headers': headers,
+        'auth': auth,
+        'body': body,
+        'status': response.status_code,
+        'response_bytes': response.calculate_content_length(),
+        'latency_ms': round((time.perf_counter() - request.environ['capture.perf']) * 1000, 3),
+    }
+
+
+'''
+setup_capture(app)
+    opt-in traffic capture for benchmarks/replay.py, off until
+    TRAFFIC_CAPTURE_PATH is set (config or environment), then every request
+    except POST /batch sub-requests, which the batch replays, is written as
+    a JSON line by an AuditLog writer with the TRAFFIC_CAPTURE prefix, so it
+    never blocks a request and drops records instead of sampling them
+'''
+
+
+def setup_capture(app):
+    app.config.setdefault('TRAFFIC_CAPTURE_PATH', os.environ.get('TRAFFIC_CAPTURE_PATH'))
+    app.config.setdefault('TRAFFIC_CAPTURE_SAMPLE_READS', 1)
+    lock = threading.Lock()
+
+    def writer():
+        capture_log = app.extensions.get('traffic_capture')
+        if capture_log is None:
+            with lock:
+                capture_log = app.extensions.get('traffic_capture')
+                if capture_log is None:
+                    capture_log = app.extensions['traffic_capture'] = AuditLog(
+                        app, 'TRAFFIC_CAPTURE', app.config['TRAFFIC_CAPTURE_PATH'])
+        return capture_log
+
+    @app.before_request
+    def start_capture():
+        if current_app.config['TRAFFIC_CAPTURE_PATH'] and not request.environ.get(SUBREQUEST_KEY):
+            request.environ['capture.started'] = time.time()
+            request.environ['capture.perf'] = time.perf_counter()
+
+    @app.after_request
+    def capture_request(response):
+        if 'capture.started' in request.environ:
+            writer().record(capture_record(response))
+        return response
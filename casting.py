@@ -0,0 +1,168 @@
+import heapq
+import json
+import threading
+from bisect import bisect_left, insort
+from itertools import islice
+from flask import current_app
+from sqlalchemy import func
+from models import db, Actor, Change, TABLES_TAG
+from shared_cache import cache, reads_uncommitted
+
+MAX_AGE = 130
+CATCH_UP_LIMIT = 1000
+
+'''
+ActorIndex
+    in-memory index of actor ages per gender behind GET /actors/match, each
+    gender maps to a list of (age, id) kept sorted so the actors of an age
+    band are found with two binary searches, whatever the number of actors
+
+    it is loaded once per worker and then kept current from the change log,
+    every Actor insert, update and delete records a change in its own
+    transaction and refresh() applies those committed since the last one
+    it saw, including the writes of other workers
+    the change log is not in id order, a delete may come before the create
+    it undoes, so deleted ids keep the version they were deleted at
+'''
+
+
+class ActorIndex(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.generation = None
+        self.actors = {}
+        self.genders = {}
+        self.deleted = {}
+
+    def refresh(self, session=None):
+        session = session or db.session
+        with self.lock:
+            # db_drop_and_create_all() restarts the change log
+            generation = cache.generation(TABLES_TAG)
+            if self.cursor is None or generation != self.generation:
+                self.generation = generation
+                self.load(session)
+            while True:
+                changes = Change.since(self.cursor, ('actors',), CATCH_UP_LIMIT, session)
+                for change in changes:
+                    self.apply(change)
+                if changes:
+                    self.cursor = changes[-1].id
+                if len(changes) < CATCH_UP_LIMIT:
+                    return
+
+    def load(self, session):
+        # read the cursor before the rows, changes committed in between
+        # are applied again by refresh() and skipped by their version
+        self.cursor = Change.head(session)
+        self.actors = {}
+        self.genders = {}
+        self.deleted = {}
+        for id, version, gender, age in session.query(Actor.id, Actor.version, Actor.gender, Actor.age):
+            self.actors[id] = (version, gender, age)
+            self.genders.setdefault(gender, []).append((age, id))
+        for entries in self.genders.values():
+            entries.sort()
+
+    def apply(self, change):
+        current = self.actors.get(change.resource_id)
+        if change.operation == 'delete':
+            self.remove(change.resource_id)
+            self.deleted[change.resource_id] = change.version
+        elif change.version <= self.deleted.get(change.resource_id, 0):
+            return
+        elif current is None or current[0] < change.version:
+            data = json.loads(change.data)
+            self.remove(change.resource_id)
+            self.add(change.resource_id, change.version, data['gender'], data['age'])
+
+    def add(self, id, version, gender, age):
+        self.actors[id] = (version, gender, age)
+        insort(self.genders.setdefault(gender, []), (age, id))
+
+    def remove(self, id):
+        entry = self.actors.pop(id, None)
+        if entry is not None:
+            entries = self.genders[entry[1]]
+            del entries[bisect_left(entries, (entry[2], id))]
+
+    def match(self, gender, age_min, age_max, exclude, limit):
+        """Returns the number of actors in the band and the ids of the
+        best ranked limit of them, see ranked()
+        """
+        with self.lock:
+            genders = [gender] if gender is not None else list(self.genders)
+            total = 0
+            streams = []
+            for name in genders:
+                entries = self.genders.get(name, [])
+                lo = bisect_left(entries, (age_min,))
+                hi = bisect_left(entries, (age_max + 1,))
+                total += hi - lo
+                streams.append(ranked(entries, lo, hi, age_min + age_max))
+
+            for id in exclude:
+                entry = self.actors.get(id)
+                if entry is not None and entry[1] in genders and age_min <= entry[2] <= age_max:
+                    total -= 1
+            matches = (id for _, _, id in heapq.merge(*streams) if id not in exclude)
+            return total, list(islice(matches, limit))
+
+
+actor_index = ActorIndex()
+
+'''
+ranked(entries, lo, hi, middle)
+    yields (distance, age, id) for entries[lo:hi] ordered by distance from
+    the middle of the age band (middle is twice the midpoint, so it stays
+    an integer), younger first on equal distance, then by id
+    it walks outwards from the midpoint one age at a time, so taking the
+    first n results costs O(log len(entries) + n)
+'''
+
+
+def ranked(entries, lo, hi, middle):
+    right = bisect_left(entries, ((middle + 1) // 2,), lo, hi)
+    left = right
+    while left > lo or right < hi:
+        if right >= hi or (left > lo and middle - 2 * entries[left - 1][0] <= 2 * entries[right][0] - middle):
+            age = entries[left - 1][0]
+            start = bisect_left(entries, (age,), lo, left)
+            group, left = entries[start:left], start
+        else:
+            age = entries[right][0]
+            end = bisect_left(entries, (age + 1,), right, hi)
+            group, right = entries[right:end], end
+        distance = abs(2 * age - middle)
+        for _, id in group:
+            yield distance, age, id
+
+
+'''
+match_actors(gender, age_min, age_max, exclude, limit)
+    returns the number of actors of gender (any gender when None) aged
+    age_min to age_max, leaving out the ids in exclude, and the best ranked
+    limit of them in rank order
+    ACTOR_INDEX_ENABLED = False answers from the (gender, age) database
+    index instead of the in-memory one, with the same ranking, so do batch
+    sub-requests, the index must not move its cursor past changes that
+    the batch may still roll back
+'''
+
+
+def match_actors(gender, age_min, age_max, exclude, limit):
+    if not current_app.config.get('ACTOR_INDEX_ENABLED', True) or reads_uncommitted():
+        query = Actor.query.filter(Actor.age.between(age_min, age_max))
+        if gender is not None:
+            query = query.filter(Actor.gender == gender)
+        if exclude:
+            query = query.filter(~Actor.id.in_(exclude))
+        distance = func.abs(2 * Actor.age - (age_min + age_max))
+        return query.count(), query.order_by(distance, Actor.age, Actor.id).limit(limit).all()
+
+    actor_index.refresh()
+    total, ids = actor_index.match(gender, age_min, age_max, exclude, limit)
+    actors = {actor.id: actor for actor in Actor.query.filter(Actor.id.in_(ids))} if ids else {}
+    return total, [actors[id] for id in ids if id in actors]
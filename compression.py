@@ -0,0 +1,103 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain')
+
+'''
+CompressedBodyCache
+    bounded LRU of compressed bodies keyed by the digest of the uncompressed
+    body and the encoding, so a hot collection response that is rebuilt
+    with the same bytes is compressed once rather than on every request
+'''
+
+
+class CompressedBodyCache(object):
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+'''
+setup_compression(app)
+    compresses responses with brotli or gzip as negotiated by the
+    Accept-Encoding request header
+    COMPRESS_MIN_SIZE: smallest body in bytes worth compressing (500)
+    COMPRESS_LEVEL: gzip level 1-9 (6)
+    COMPRESS_BROTLI_QUALITY: brotli quality 0-11 (4)
+    COMPRESS_CACHE_SIZE: compressed bodies kept in memory (128)
+'''
+
+
+def setup_compression(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+    app.config.setdefault('COMPRESS_CACHE_SIZE', 128)
+    cache = CompressedBodyCache(app.config['COMPRESS_CACHE_SIZE'])
+
+    @app.after_request
+    def compress_response(response):
+        if response.is_streamed or response.direct_passthrough or not 200 <= response.status_code < 300:
+            return response
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+
+        body = response.get_data()
+        if len(body) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+
+        key = (hashlib.sha1(body).digest(), encoding)
+        compressed = cache.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding, app.config)
+            cache.put(key, compressed)
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return cache
+
+
+def choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(body, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(body, compresslevel=config['COMPRESS_LEVEL'])
@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from queue import Queue, Empty, Full
+from flask import json
+from models import db, Change, read_only
+
+KEEPALIVE_SECONDS = 15
+POLL_SECONDS = 0.5
+QUEUE_SIZE = 1000
+REPLAY_LIMIT = 1000
+# each open stream holds a gthread thread until its token expires, half of
+# them stay free for regular routes
+MAX_STREAMS = int(os.environ.get('GUNICORN_THREADS', 32)) // 2
+
+'''
+ChangeHub
+    fans change log rows out to every GET /events subscriber of a process
+    a single daemon thread polls the changes table after the last cursor it
+    has seen and copies each change into the queue of each subscriber that
+    may read the resource, so the database sees one listener per worker
+    however many clients are connected
+
+    the thread starts on the first subscription, after gunicorn has forked
+    subscribe() returns None once EVENTS_MAX_STREAMS streams are open
+    a subscriber whose queue fills up is closed, it reconnects with
+    Last-Event-ID and catches up from the change log
+'''
+
+
+class ChangeHub(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.poll_seconds = app.config.get('EVENTS_POLL_SECONDS', POLL_SECONDS)
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.cursor = 0
+
+    def subscribe(self, resources):
+        subscription = Subscription(resources)
+        with self.lock:
+            if len(self.subscribers) >= self.app.config.get('EVENTS_MAX_STREAMS', MAX_STREAMS):
+                return None
+            self.subscribers.add(subscription)
+            if self.thread is None or not self.thread.is_alive():
+                # read the starting cursor before the caller replays its
+                # backlog, so no change falls between the two
+                self.cursor = Change.head()
+                self.thread = threading.Thread(target=self.run, name='change-hub', daemon=True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.poll_seconds)
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        return
+                try:
+                    with read_only():
+                        changes = Change.since(self.cursor, ('movies', 'actors'), REPLAY_LIMIT)
+                        events = [(change.position, change.format()) for change in changes]
+                finally:
+                    db.session.remove()
+                if events:
+                    self.cursor = events[-1][1]['cursor']
+                    self.publish(events)
+
+    def publish(self, events):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            for position, event in events:
+                if event['resource'] in subscription.resources:
+                    subscription.put((position, event))
+
+
+class Subscription(object):
+
+    def __init__(self, resources):
+        self.resources = set(resources)
+        self.queue = Queue(QUEUE_SIZE)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.close()
+
+    def close(self):
+        # drop the backlog so the end-of-stream marker always fits
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        self.queue.put_nowait(None)
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+
+'''
+format_event(event)
+    renders a change as a Server-Sent Events message, the change cursor is
+    the event id so browsers resume with Last-Event-ID after a reconnect
+'''
+
+
+def format_event(event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event['cursor'], event['operation'], json.dumps(event))
+
+
+'''
+event_stream(subscription, backlog, last_position, expires_at, resync)
+    yields the replayed backlog, then live events from the subscription
+    with a comment line as keep-alive, and ends when the token expires
+    backlog and subscription hold (position, event) pairs, see Change, live
+    events at or before last_position were already sent
+    with resync set the backlog is only the first EVENTS_REPLAY_LIMIT
+    changes missed, the stream then ends with a resync event whose data
+    is the cursor to page GET /changes from before reconnecting
+'''
+
+
+def event_stream(subscription, backlog, last_position, expires_at=None, resync=False):
+    yield 'retry: 3000\n\n'
+    for position, event in backlog:
+        yield format_event(event)
+        last_position = position
+
+    if resync:
+        yield 'event: resync\ndata: {}\n\n'.format(json.dumps({'since': last_position[1]}))
+        return
+
+    while expires_at is None or time.time() < expires_at:
+        try:
+            event = subscription.get(KEEPALIVE_SECONDS)
+        except Empty:
+            yield ': keep-alive\n\n'
+            continue
+        if event is None:
+            return
+        position, event = event
+        # events already sent as part of the replayed backlog
+        if last_position is not None and position <= last_position:
+            continue
+        yield format_event(event)
+        last_position = position
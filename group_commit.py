@@ -0,0 +1,148 @@
+import threading
+import time
+from flask import current_app
+from models import db
+
+WINDOW_MS = 2
+MAX_ROWS = 100
+
+'''
+GroupCommit
+    batches concurrent single-row inserts of a model within a process, the
+    first insert to arrive (the leader) waits GROUP_COMMIT_WINDOW_MS, and
+    for as long as the previous group of the model is still committing,
+    or until GROUP_COMMIT_MAX_ROWS rows are waiting, then inserts them all
+    with model.insert_rows() and commits them in one transaction, so the
+    rows share one commit instead of paying for one each and groups grow
+    with the write rate and the commit latency
+
+    every waiting insert gets its own row back, if the group fails its rows
+    are retried one per transaction so each gets its own result or error
+    and one bad row cannot fail the others
+
+    it only pays off when a worker serves concurrent requests (gunicorn
+    --threads or gevent workers), a lone insert still waits for the window
+
+    groups counts the transactions committed by leaders, rows the rows they
+    inserted and retried the rows inserted again after their group failed
+'''
+
+
+class GroupCommit(object):
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.committing = set()
+        self.groups = 0
+        self.rows = 0
+        self.retried = 0
+
+    def insert(self, model, values, window, max_rows):
+        entry = Pending(values)
+        with self.lock:
+            waiting = self.pending.setdefault(model, [])
+            waiting.append(entry)
+            leader = len(waiting) == 1
+            if len(waiting) == max_rows:
+                self.lock.notify_all()
+            if leader:
+                deadline = time.monotonic() + window
+                while len(waiting) < max_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 and model not in self.committing:
+                        break
+                    self.lock.wait(remaining if remaining > 0 else None)
+                del self.pending[model]
+                self.committing.add(model)
+
+        if not leader:
+            entry.done.wait()
+        else:
+            try:
+                # rows that arrived while the leader was waking up join as well
+                for start in range(0, len(waiting), max_rows):
+                    self.commit(model, waiting[start:start + max_rows])
+            finally:
+                with self.lock:
+                    self.committing.discard(model)
+                    self.lock.notify_all()
+
+        if entry.error is not None:
+            raise entry.error
+        return entry.row
+
+    def commit(self, model, group):
+        try:
+            try:
+                rows = model.insert_rows([entry.values for entry in group])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                for entry in group:
+                    self.commit_one(model, entry)
+                return
+            for entry, row in zip(group, rows):
+                entry.row = row
+            with self.lock:
+                self.groups += 1
+                self.rows += len(group)
+        finally:
+            for entry in group:
+                if entry.row is None and entry.error is None:
+                    entry.error = RuntimeError('the group commit was interrupted')
+                entry.done.set()
+
+    def commit_one(self, model, entry):
+        try:
+            entry.row = model.insert_rows([entry.values])[0]
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            entry.row = None
+            entry.error = error
+            return
+        with self.lock:
+            self.groups += 1
+            self.rows += 1
+            self.retried += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'groups': self.groups,
+                'rows': self.rows,
+                'retried': self.retried,
+                'waiting': sum(len(waiting) for waiting in self.pending.values()),
+            }
+
+
+class Pending(object):
+
+    def __init__(self, values):
+        self.values = values
+        self.done = threading.Event()
+        self.row = None
+        self.error = None
+
+
+group = GroupCommit()
+
+'''
+insert_row(model, values)
+    inserts and commits a movie or actor from its column values, returns
+    the new row, which model.format_row() formats
+    with GROUP_COMMIT_ENABLED = True it goes through the group commit,
+    except inside an atomic POST /batch where the batch commits its writes
+'''
+
+
+def insert_row(model, values):
+    config = current_app.config
+    if not config.get('GROUP_COMMIT_ENABLED', False) or db.session().transaction.nested:
+        instance = model(**values)
+        instance.insert()
+        return instance
+    return group.insert(model, values,
+                        config.get('GROUP_COMMIT_WINDOW_MS', WINDOW_MS) / 1000.0,
+                        config.get('GROUP_COMMIT_MAX_ROWS', MAX_ROWS))
@@ -0,0 +1,15 @@
+# gunicorn reads this file from the working directory on start
+import os
+
+# GET /events streams stay open, with sync workers each one would take a
+# whole worker process, threads keep the others serving
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+
+def post_worker_init(worker):
+    # warm the freshly forked worker before it accepts its first request,
+    # /readyz reports the outcome
+    readiness = worker.wsgi.extensions.get('readiness')
+    if readiness is not None:
+        readiness.warm_up()
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from flask import jsonify
+from sqlalchemy.orm import configure_mappers
+from auth import get_jwks
+from casting import actor_index
+from models import db, Movie, Actor, Change, StatBucket, read_only
+
+logger = logging.getLogger(__name__)
+
+RETRY_SECONDS = 5
+PING_SECONDS = 5
+
+'''
+Readiness
+    warm-up state of one worker process, ready once every warm-up step of
+    warm_up() has passed, after that the database is pinged at most once
+    every READY_PING_SECONDS so probes stay cheap
+    a failed warm-up is retried at most every WARM_UP_RETRY_SECONDS
+    both run on a connection of their own, never on the scoped session of
+    the calling thread, whose transaction may belong to a request
+'''
+
+
+class Readiness(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.checks = {
+            'database': False,
+            'jwks': False,
+            'queries': False,
+            'serialization': False,
+        }
+        self.attempted_at = None
+        self.pinged_at = None
+
+    @property
+    def ready(self):
+        return all(self.checks.values())
+
+    def warm_up(self):
+        with self.lock:
+            retry = self.app.config.get('WARM_UP_RETRY_SECONDS', RETRY_SECONDS)
+            if self.ready or (self.attempted_at and time.time() - self.attempted_at < retry):
+                return self.ready
+            self.attempted_at = time.time()
+            with self.app.app_context(), read_only():
+                try:
+                    connection = db.engine.connect()
+                except Exception:
+                    logger.exception('warm-up could not connect')
+                    return False
+                session = db.create_session({'bind': connection})()
+                try:
+                    for name, step in WARM_UP_STEPS:
+                        if self.checks[name]:
+                            continue
+                        try:
+                            step(self.app, session)
+                            self.checks[name] = True
+                        except Exception:
+                            logger.exception('warm-up step %s failed', name)
+                            session.rollback()
+                finally:
+                    session.close()
+                    connection.close()
+            self.pinged_at = time.time()
+            return self.ready
+
+    def ping(self):
+        interval = self.app.config.get('READY_PING_SECONDS', PING_SECONDS)
+        if self.pinged_at and time.time() - self.pinged_at < interval:
+            return self.checks['database']
+        with self.app.app_context(), read_only():
+            try:
+                with db.engine.connect() as connection:
+                    connection.execute('SELECT 1')
+                self.checks['database'] = True
+            except Exception:
+                logger.exception('readiness ping failed')
+                self.checks['database'] = False
+        self.pinged_at = time.time()
+        return self.checks['database']
+
+
+def open_pool(app, session):
+    # check out several connections at once so the pool holds them open
+    count = app.config.get('WARM_UP_CONNECTIONS', 2)
+    connections = [db.engine.connect() for _ in range(count)]
+    try:
+        for connection in connections:
+            connection.execute('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def load_jwks(app, session):
+    if app.config.get('WARM_UP_JWKS', True):
+        get_jwks()
+
+
+def prepare_queries(app, session):
+    # runs the hot reads once, SQLAlchemy 1.3 keeps no compiled Core
+    # statements, so compiling the UPDATE and DELETE ahead warms nothing
+    configure_mappers()
+    for model in (Movie, Actor):
+        session.query(model).filter(model.id == 0).first()
+        session.query(model).order_by(model.id).limit(1).all()
+    Change.since(0, ('movies', 'actors'), 1, session)
+    StatBucket.summary('movies', session)
+    if app.config.get('ACTOR_INDEX_ENABLED', True):
+        actor_index.refresh(session)
+
+
+def first_serialization(app, session):
+    with app.test_request_context():
+        jsonify({
+            'movies': [movie.format() for movie in session.query(Movie).limit(1)],
+            'actors': [actor.format() for actor in session.query(Actor).limit(1)],
+        }).get_data()
+
+
+WARM_UP_STEPS = (
+    ('database', open_pool),
+    ('jwks', load_jwks),
+    ('queries', prepare_queries),
+    ('serialization', first_serialization),
+)
@@ -0,0 +1,92 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, abort, current_app, make_response
+from models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+DEFAULT_TTL = 24 * 60 * 60
+# longer than a request may run before gunicorn kills its worker
+PENDING_SECONDS = 60
+
+'''
+Idempotency keys for POST endpoints
+    clients send an Idempotency-Key header on a create request and may retry
+    it freely, the first successful response per key and JWT subject is
+    stored and later retries replay it without running the handler again
+
+    it should abort with 400 if the key is longer than 255 characters
+    it should abort with 409 if the first request with the key is in flight,
+    for at most IDEMPOTENCY_PENDING_SECONDS, after that its worker is taken
+    to have died and a retry runs the request again
+    it should abort with 422 if the key was used for a different request
+'''
+
+
+def request_fingerprint():
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def key_expiry():
+    ttl = current_app.config.get('IDEMPOTENCY_KEY_TTL', DEFAULT_TTL)
+    return datetime.utcnow() - timedelta(seconds=ttl)
+
+
+def pending_expiry():
+    lease = current_app.config.get('IDEMPOTENCY_PENDING_SECONDS', PENDING_SECONDS)
+    return datetime.utcnow() - timedelta(seconds=lease)
+
+
+def replay(record):
+    response = current_app.response_class(
+        record.body,
+        status=record.status_code,
+        mimetype='application/json'
+    )
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+'''
+@idempotent decorator
+    must be applied below @requires_auth so the decoded payload is passed in
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return f(payload, *args, **kwargs)
+        if len(key) > 255:
+            abort(400)
+
+        subject = payload.get('sub', '')
+        fingerprint = request_fingerprint()
+        record = IdempotencyKey.claim(key, subject, fingerprint, key_expiry(), pending_expiry())
+        if record is not None:
+            if record.request_hash != fingerprint:
+                abort(422)
+            if record.status_code is None:
+                abort(409)
+            return replay(record)
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except BaseException:
+            IdempotencyKey.release(key, subject)
+            raise
+
+        if 200 <= response.status_code < 300:
+            IdempotencyKey.complete(key, subject, response.status_code,
+                                    response.get_data(as_text=True))
+        else:
+            IdempotencyKey.release(key, subject)
+        return response
+
+    return wrapper
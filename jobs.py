@@ -0,0 +1,173 @@
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+from flask import json
+from models import db, Movie, Actor, Job, StatBucket
+from schemas import movie_rows, actor_rows, row_ids, no_payload
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+POLL_SECONDS = 1
+STALE_SECONDS = 10 * 60
+
+'''
+Job kinds
+    every kind names the permissions needed to submit or read it, the
+    function running it as handler(payload, job) and the schema its payload
+    is validated with on submission (schemas.py), handlers commit their
+    work in chunks and report progress on the job between chunks
+
+    import_movies / import_actors: payload {"rows": [...]} of POST bodies
+    export_movies / export_actors: result {"movies": [...]} / {"actors": [...]}
+    delete_movies / delete_actors: payload {"ids": [...]}
+    rebuild_stats: recomputes the /stats summary tables
+'''
+
+
+def import_rows(model, rows, job):
+    if not isinstance(rows, list):
+        raise ValueError('payload.rows must be a list')
+
+    created = []
+    for start in range(0, len(rows), CHUNK_SIZE):
+        for row in rows[start:start + CHUNK_SIZE]:
+            instance = model(**row)
+            instance.insert(commit=False)
+            created.append(instance.id)
+        db.session.commit()
+        job.report_progress(min(99, (start + CHUNK_SIZE) * 100 // len(rows)))
+    return {'created': created}
+
+
+def export_rows(model, resource, job):
+    rows = []
+    last_id = 0
+    total = model.query.count() or 1
+    while True:
+        # keyset pagination keeps memory flat on large tables
+        chunk = model.query.filter(model.id > last_id).order_by(model.id).limit(CHUNK_SIZE).all()
+        if not chunk:
+            break
+        rows.extend(row.format() for row in chunk)
+        last_id = chunk[-1].id
+        for row in chunk:
+            db.session.expunge(row)
+        job.report_progress(min(99, len(rows) * 100 // total))
+    return {resource: rows}
+
+
+def delete_rows(model, ids, job):
+    if not isinstance(ids, list):
+        raise ValueError('payload.ids must be a list')
+
+    deleted = []
+    for start in range(0, len(ids), CHUNK_SIZE):
+        for id in ids[start:start + CHUNK_SIZE]:
+            if model.delete_by_id(int(id), commit=False) is not None:
+                deleted.append(id)
+        db.session.commit()
+        job.report_progress(min(99, (start + CHUNK_SIZE) * 100 // len(ids)))
+    return {'deleted': deleted}
+
+
+def rebuild_stats(payload, job):
+    StatBucket.rebuild()
+    return {'rebuilt': True}
+
+
+JOB_KINDS = {
+    'import_movies': (('post:movies',), lambda payload, job: import_rows(Movie, payload.get('rows'), job),
+                      movie_rows),
+    'import_actors': (('post:actors',), lambda payload, job: import_rows(Actor, payload.get('rows'), job),
+                      actor_rows),
+    'export_movies': (('get:movies',), lambda payload, job: export_rows(Movie, 'movies', job), no_payload),
+    'export_actors': (('get:actors',), lambda payload, job: export_rows(Actor, 'actors', job), no_payload),
+    'delete_movies': (('delete:movies',), lambda payload, job: delete_rows(Movie, payload.get('ids'), job),
+                      row_ids),
+    'delete_actors': (('delete:actors',), lambda payload, job: delete_rows(Actor, payload.get('ids'), job),
+                      row_ids),
+    'rebuild_stats': (('patch:movies', 'patch:actors'), rebuild_stats, no_payload),
+}
+
+
+def job_permissions(kind):
+    return JOB_KINDS[kind][0]
+
+
+def job_payload_schema(kind):
+    return JOB_KINDS[kind][2]
+
+
+'''
+run_next(worker)
+    claims and runs the oldest queued job, returns False when the queue is empty
+    a failing job rolls back its current chunk and records the error
+'''
+
+
+def run_next(worker):
+    job = Job.claim(worker)
+    if job is None:
+        return False
+
+    handler = JOB_KINDS[job.kind][1]
+    try:
+        result = handler(json.loads(job.payload) or {}, job)
+    except Exception as error:
+        db.session.rollback()
+        logger.error('job %s failed\n%s', job.id, traceback.format_exc())
+        job.finish(error='{}: {}'.format(type(error).__name__, error))
+    else:
+        job.finish(result=result)
+    return True
+
+
+'''
+work(app)
+    the loop of one worker process, polls the queue every JOB_POLL_SECONDS
+    and puts jobs abandoned by a dead worker (no heartbeat for
+    JOB_STALE_SECONDS) back in the queue
+'''
+
+
+def work(app):
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    poll_seconds = app.config.get('JOB_POLL_SECONDS', POLL_SECONDS)
+    stale_seconds = app.config.get('JOB_STALE_SECONDS', STALE_SECONDS)
+    with app.app_context():
+        # connections inherited from the parent process must not be shared
+        db.engine.dispose()
+        logger.info('job worker %s started', worker)
+        while True:
+            try:
+                Job.requeue_stale(datetime.utcnow() - timedelta(seconds=stale_seconds))
+                while run_next(worker):
+                    pass
+            except Exception:
+                db.session.rollback()
+                logger.exception('job worker %s failed to poll', worker)
+            finally:
+                db.session.remove()
+            time.sleep(poll_seconds)
+
+
+'''
+start_workers(app, processes)
+    runs work(app) in processes worker processes, one per core by default,
+    and waits for them
+'''
+
+
+def start_workers(app, processes=None):
+    processes = processes or os.cpu_count() or 1
+    workers = [multiprocessing.Process(target=work, args=(app,), name='job-worker-{}'.format(n))
+               for n in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
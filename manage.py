@@ -2,7 +2,9 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import create_app
-from models import db, Movie, Actor
+from models import db, Movie, Actor, IdempotencyKey, StatBucket
+from idempotency import key_expiry
+from jobs import start_workers
 
 app = create_app()
 
@@ -28,5 +30,25 @@ def seed():
     Actor(name='Nicole Kidman', gender='female', age=53).insert()
 
 
+# drop stored idempotent responses older than IDEMPOTENCY_KEY_TTL
+@manager.command
+def purge_idempotency_keys():
+    count = IdempotencyKey.purge(key_expiry())
+    print('purged {} idempotency keys'.format(count))
+
+
+# recompute the /stats summary tables from the movies and actors tables
+@manager.command
+def rebuild_stats():
+    StatBucket.rebuild()
+    print('rebuilt statistics summaries')
+
+
+# run queued POST /jobs work, one process per core unless --processes is given
+@manager.option('-p', '--processes', dest='processes', type=int, default=None)
+def worker(processes):
+    start_workers(app, processes)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -79,11 +79,15 @@ def run_migrations_online():
     )
 
     with connectable.connect() as connection:
+        # SQLite can't ALTER most constraints or drop columns, autogenerate
+        # batch operations that recreate the table there
+        configure_args = dict(current_app.extensions['migrate'].configure_args)
+        configure_args.setdefault('render_as_batch', connection.dialect.name == 'sqlite')
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
-            **current_app.extensions['migrate'].configure_args
+            **configure_args
         )
 
         with context.begin_transaction():
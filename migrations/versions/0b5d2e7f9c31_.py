@@ -0,0 +1,28 @@
+"""record the writing transaction of each change
+
+Revision ID: 0b5d2e7f9c31
+Revises: d62a0f8c4b17
+Create Date: 2026-10-19 23:12:48.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b5d2e7f9c31'
+down_revision = 'd62a0f8c4b17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # changes already in the log sort before any new one, in id order
+    op.add_column('changes', sa.Column('txid', sa.BigInteger(), server_default='0', nullable=False))
+    op.create_index('ix_changes_txid_id', 'changes', ['txid', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_changes_txid_id', table_name='changes')
+    with op.batch_alter_table('changes') as batch_op:
+        batch_op.drop_column('txid')
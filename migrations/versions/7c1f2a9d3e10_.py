@@ -0,0 +1,29 @@
+"""add version column for optimistic concurrency
+
+Revision ID: 7c1f2a9d3e10
+Revises: 48ba25766e4f
+Create Date: 2026-10-19 09:12:41.118302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1f2a9d3e10'
+down_revision = '48ba25766e4f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('movies', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    # batch mode recreates the tables on SQLite, which cannot drop columns
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('version')
+    with op.batch_alter_table('actors') as batch_op:
+        batch_op.drop_column('version')
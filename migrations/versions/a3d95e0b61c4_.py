@@ -0,0 +1,32 @@
+"""add idempotency_keys table
+
+Revision ID: a3d95e0b61c4
+Revises: 7c1f2a9d3e10
+Create Date: 2026-10-19 10:02:17.540921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d95e0b61c4'
+down_revision = '7c1f2a9d3e10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('subject', sa.String(length=255), nullable=False),
+    sa.Column('request_hash', sa.String(length=64), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key', 'subject')
+    )
+
+
+def downgrade():
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,24 @@
+"""add composite gender, age index on actors
+
+Revision ID: b7e3c9a14d62
+Revises: f4a81c3d5e27
+Create Date: 2026-10-19 17:42:10.318745
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3c9a14d62'
+down_revision = 'f4a81c3d5e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_age', table_name='actors')
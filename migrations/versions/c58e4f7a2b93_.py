@@ -0,0 +1,50 @@
+"""add stat_buckets summary table
+
+Revision ID: c58e4f7a2b93
+Revises: a3d95e0b61c4
+Create Date: 2026-10-19 11:26:03.907714
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e4f7a2b93'
+down_revision = 'a3d95e0b61c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stat_buckets',
+    sa.Column('resource', sa.String(length=64), nullable=False),
+    sa.Column('dimension', sa.String(length=64), nullable=False),
+    sa.Column('bucket', sa.String(length=64), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('resource', 'dimension', 'bucket')
+    )
+    # existing rows are counted once here, writes keep the table current
+    op.execute("""
+        INSERT INTO stat_buckets (resource, dimension, bucket, count)
+        SELECT 'actors', 'gender', gender, count(*) FROM actors GROUP BY gender
+    """)
+    op.execute("""
+        INSERT INTO stat_buckets (resource, dimension, bucket, count)
+        SELECT 'actors', 'age', (age / 10 * 10) || '-' || (age / 10 * 10 + 9), count(*)
+        FROM actors GROUP BY age / 10 * 10
+    """)
+    # SQLite has no extract(), strftime('%Y') gives the year as text
+    if op.get_bind().dialect.name == 'sqlite':
+        year = "CAST(CAST(strftime('%Y', release_date) AS INTEGER) AS VARCHAR)"
+    else:
+        year = 'CAST(CAST(extract(year FROM release_date) AS INTEGER) AS VARCHAR)'
+    op.execute("""
+        INSERT INTO stat_buckets (resource, dimension, bucket, count)
+        SELECT 'movies', 'release_year', {0}, count(*)
+        FROM movies GROUP BY {0}
+    """.format(year))
+
+
+def downgrade():
+    op.drop_table('stat_buckets')
@@ -0,0 +1,34 @@
+"""never reuse movie and actor ids on sqlite
+
+Revision ID: d62a0f8c4b17
+Revises: b7e3c9a14d62
+Create Date: 2026-10-19 21:05:37.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd62a0f8c4b17'
+down_revision = 'b7e3c9a14d62'
+branch_labels = None
+depends_on = None
+
+
+def recreate(autoincrement):
+    # only SQLite reuses the largest id once its row is deleted
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table in ('movies', 'actors'):
+        with op.batch_alter_table(table, recreate='always',
+                                  table_kwargs={'sqlite_autoincrement': autoincrement}):
+            pass
+
+
+def upgrade():
+    recreate(True)
+
+
+def downgrade():
+    recreate(False)
@@ -0,0 +1,33 @@
+"""add changes log table
+
+Revision ID: e20b7d94c6a5
+Revises: c58e4f7a2b93
+Create Date: 2026-10-19 12:48:55.271036
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e20b7d94c6a5'
+down_revision = 'c58e4f7a2b93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('changes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('resource', sa.String(length=64), nullable=False),
+    sa.Column('resource_id', sa.Integer(), nullable=False),
+    sa.Column('operation', sa.String(length=16), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=True),
+    sa.Column('data', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('changes')
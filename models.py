@@ -1,32 +1,162 @@
 from sqlalchemy import Column, String, Integer, DateTime, create_engine
+from sqlalchemy import func, extract, event, select, literal, cast, union_all, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError, DisconnectionError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import get_history
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from flask import json as flask_json, current_app, request, has_request_context
 from datetime import datetime
+from dateutil.parser import parse as parse_date
+from types import SimpleNamespace
+from collections import Counter
+from contextlib import contextmanager
 import json
 import os
+import sqlite3
+import threading
+from shared_cache import cache, invalidate_on_commit, SUBREQUEST_KEY
+from row_cache import rows, refresh_on_commit
 
 database_path = os.environ['DATABASE_URL']
+TABLES_TAG = 'tables'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
 
 db = SQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    a sqlite:/// file path runs the embedded single-node mode, see setup_sqlite
 '''
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    url = make_url(database_path)
+    if url.drivername == 'sqlite' and url.database not in (None, '', ':memory:'):
+        setup_sqlite(app, os.path.join(app.root_path, url.database))
     db.app = app
     db.init_app(app)
     # db.create_all()
 
 
+'''
+setup_sqlite(app, path)
+    embedded mode for edge installs and local benchmarking, the database is
+    a local file opened with
+        journal_mode=WAL, readers never block the writer and vice versa
+        synchronous=NORMAL, fsync at checkpoints instead of every commit
+        mmap_size=SQLITE_MMAP_SIZE bytes (256 MiB)
+        cache_size=SQLITE_CACHE_SIZE (-65536, negative means KiB, 64 MiB)
+        busy_timeout=SQLITE_BUSY_TIMEOUT ms (5000) waiting for the write lock
+
+    each worker keeps up to SQLITE_POOL_SIZE (5) open connections so the
+    page cache survives between requests, SQLitePool discards connections
+    inherited across a fork so gunicorn and job workers open their own
+    transactions are begun explicitly, pysqlite's own transaction handling
+    breaks SAVEPOINT (begin_nested), as BEGIN IMMEDIATE, taking the write
+    lock up front, except in read-only requests, see may_write()
+'''
+
+
+def setup_sqlite(app, path):
+    app.config.setdefault('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+    app.config.setdefault('SQLITE_CACHE_SIZE', -64 * 1024)
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+    app.config.setdefault('SQLITE_POOL_SIZE', 5)
+    pragmas = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', int(app.config['SQLITE_MMAP_SIZE'])),
+        ('cache_size', int(app.config['SQLITE_CACHE_SIZE'])),
+        ('busy_timeout', int(app.config['SQLITE_BUSY_TIMEOUT'])),
+    )
+
+    def connect():
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        for name, value in pragmas:
+            connection.execute('PRAGMA {}={}'.format(name, value))
+        return connection
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'creator': connect,
+        'poolclass': SQLitePool,
+        'pool_size': app.config['SQLITE_POOL_SIZE'],
+    }
+
+
+class SQLitePool(QueuePool):
+    pass
+
+
+@event.listens_for(SQLitePool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(SQLitePool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection opened before a fork belongs to the parent process
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise DisconnectionError('connection opened in process {}'.format(connection_record.info['pid']))
+
+
+@event.listens_for(Engine, 'begin')
+def begin_sqlite(connection):
+    # pysqlite in autocommit mode (isolation_level None) leaves BEGIN to us
+    dbapi_connection = connection.connection.connection
+    if isinstance(dbapi_connection, sqlite3.Connection) and dbapi_connection.isolation_level is None:
+        connection.execute('BEGIN IMMEDIATE' if may_write() else 'BEGIN')
+
+
+def may_write():
+    # a deferred transaction that reads first cannot take the write lock
+    # once another connection has committed, busy_timeout does not help,
+    # so only GET, HEAD and OPTIONS requests and read_only() blocks begin
+    # without it
+    if getattr(reading, 'only', False):
+        return False
+    if not has_request_context():
+        return True
+    return request.method not in SAFE_METHODS or bool(request.environ.get(SUBREQUEST_KEY))
+
+
+reading = threading.local()
+
+
+@contextmanager
+def read_only():
+    # for readers outside a request, such as the /events poller
+    previous = getattr(reading, 'only', False)
+    reading.only = True
+    try:
+        yield
+    finally:
+        reading.only = previous
+
+
+'''
+supports_returning()
+    SQLAlchemy 1.3 compiles no RETURNING for SQLite, the write methods fall
+    back to a separate SELECT in the same transaction there
+'''
+
+
+def supports_returning():
+    return db.session.get_bind().dialect.name != 'sqlite'
+
+
 '''
 db_drop_and_create_all()
     drops the database tables and starts fresh
     can be used to initialize a clean database
+    TABLES_TAG is invalidated so per-worker indexes of the old tables reload
     !!NOTE you can change the database_filename variable to have multiple verisons of a database
 '''
 
@@ -34,78 +164,702 @@ db_drop_and_create_all()
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
+    cache.clear()
+    cache.invalidate(TABLES_TAG)
+    rows.clear()
+
+
+'''
+CatalogueMixin
+    write methods shared by Movie and Actor
+    every write calls _record_write(old, new) inside its transaction, so
+    derived data (summary statistics, the change feed) commits or rolls
+    back with the row, old is None for an insert and new is None for a delete
+    the resource's shared cache entries are invalidated and the row's
+    cached JSON fragment is refreshed once it commits
+
+    insert(commit=False) and delete_by_id(commit=False) leave the transaction
+    open so bulk jobs can commit a chunk of rows at once
+
+    insert_rows(values) inserts one row per dict of column values with a
+    single multi-row INSERT ... RETURNING, one INSERT per row on SQLite,
+    records them like _record_write() does with a statement per summary
+    bucket and one for the change log, and returns the new rows in the same
+    order without committing, see group_commit.py, every dict holds the
+    same columns
+
+    update_by_id() and delete_by_id() issue one UPDATE/DELETE ... RETURNING
+    and return the affected row, or None when no row matched, on SQLite the
+    row is read with a SELECT in the same transaction instead
+    update_by_id() bumps version and, given expected_versions, only matches
+    rows whose version is one of them (If-Match), with no values it writes
+    nothing and returns the row as it is
+    when values touch one of stat_columns the previous values are needed
+    to move the row's summary buckets, on PostgreSQL the same statement
+    returns them, UPDATE ... FROM (SELECT ... FOR UPDATE) previous ...
+    RETURNING the new row and previous.*, on SQLite they are read first
+
+    page_json(after, limit) returns the rows after id `after`, at most
+    limit of them, as a JSON array joined from the cached fragments
+    (row_cache) so unchanged rows are serialized only once, and the number
+    of rows in it
+
+    row_count(estimate=True) sums the summary buckets of count_dimension,
+    which every write keeps current, instead of counting the table
+'''
+
+
+class CatalogueMixin(object):
+    stat_columns = ()
+    count_dimension = None
+
+    def insert(self, commit=True):
+        db.session.add(self)
+        db.session.flush()
+        self._record_write(None, self)
+        if commit:
+            db.session.commit()
+
+    def update(self):
+        previous = self._previous_state()
+        db.session.flush()
+        self._record_write(previous, self)
+        db.session.commit()
+
+    def delete(self):
+        self._record_write(self, None)
+        db.session.delete(self)
+        db.session.commit()
+
+    @classmethod
+    def insert_rows(cls, values):
+        table = cls.__table__
+        values = [cls.column_values(dict(row, version=1)) for row in values]
+        if supports_returning():
+            # RETURNING follows no defined order, but serial ids are drawn
+            # in insert order, so rows go in ordered by their position and
+            # come back sorted by id
+            names = list(values[0])
+
+            def positioned(position, row):
+                columns = [cast(literal(row[name]), table.c[name].type).label(name) for name in names]
+                return select(columns + [literal(position).label('position')])
+
+            source = union_all(*[positioned(position, row) for position, row in enumerate(values)]).alias('source')
+            stmt = table.insert().from_select(
+                names, select([source.c[name] for name in names]).order_by(source.c.position))
+            rows = sorted(db.session.execute(stmt.returning(*table.c)).fetchall(), key=lambda row: row.id)
+        else:
+            ids = [db.session.execute(table.insert(), row).inserted_primary_key[0] for row in values]
+            found = {row.id: row for row in db.session.execute(table.select().where(table.c.id.in_(ids)))}
+            rows = [found[id] for id in ids]
+        cls._record_inserts(rows)
+        return rows
+
+    @classmethod
+    def update_by_id(cls, id, values, expected_versions=None):
+        table = cls.__table__
+        if expected_versions is not None and not expected_versions:
+            return None
+        values = cls.column_values(values)
+        stmt = table.update() if values else table.select()
+        stmt = stmt.where(table.c.id == id)
+        if expected_versions is not None:
+            stmt = stmt.where(table.c.version.in_(expected_versions))
+        if not values:
+            return db.session.execute(stmt).first()
+        stmt = stmt.values(version=table.c.version + 1, **values)
+        moves_buckets = bool(set(values) & set(cls.stat_columns))
+
+        try:
+            old = None
+            if supports_returning() and moves_buckets:
+                # the subquery locks the row the UPDATE locks anyway and,
+                # after a concurrent writer, reads its committed version
+                previous = select([table.c.id] + [table.c[name] for name in cls.stat_columns]) \
+                    .where(table.c.id == id).with_for_update().alias('previous')
+                row = db.session.execute(stmt.where(table.c.id == previous.c.id).returning(
+                    *table.c, *[previous.c[name].label('previous_' + name) for name in cls.stat_columns]
+                )).first()
+                if row is not None:
+                    old = SimpleNamespace(**{name: row['previous_' + name] for name in cls.stat_columns})
+            elif supports_returning():
+                row = db.session.execute(stmt.returning(*table.c)).first()
+            else:
+                if moves_buckets:
+                    old = db.session.execute(table.select().where(table.c.id == id)).first()
+                row = None
+                if db.session.execute(stmt).rowcount:
+                    row = db.session.execute(table.select().where(table.c.id == id)).first()
+            if row is not None:
+                cls._record_write(old if old is not None else row, row)
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            raise
+        return row
+
+    @classmethod
+    def delete_by_id(cls, id, commit=True):
+        table = cls.__table__
+        stmt = table.delete().where(table.c.id == id)
+        try:
+            if supports_returning():
+                row = db.session.execute(stmt.returning(*table.c)).first()
+            else:
+                row = db.session.execute(table.select().where(table.c.id == id)).first()
+                if row is not None and not db.session.execute(stmt).rowcount:
+                    row = None
+            if row is not None:
+                cls._record_write(row, None)
+            if commit:
+                db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            raise
+        return row
+
+    @classmethod
+    def exists(cls, id):
+        return db.session.query(cls.id).filter(cls.id == id).scalar() is not None
+
+    @classmethod
+    def page_json(cls, after=0, limit=None):
+        table = cls.__table__
+        query = table.select().where(table.c.id > after).order_by(table.c.id).limit(limit)
+        page = db.session.execute(query).fetchall()
+        return rows.join(cls.__tablename__, page, cls.serializer()), len(page)
+
+    @classmethod
+    def row_count(cls, estimate=False):
+        if estimate:
+            return StatBucket.total(cls.__tablename__, cls.count_dimension)
+        return db.session.query(func.count(cls.id)).scalar()
+
+    @classmethod
+    def serializer(cls):
+        # flask_json.dumps() looks the app settings up again for every row,
+        # build the encoder once instead
+        encode = current_app.json_encoder(
+            ensure_ascii=current_app.config['JSON_AS_ASCII'],
+            sort_keys=current_app.config['JSON_SORT_KEYS']
+        ).encode
+        format_row = cls.format_row
+        return lambda row: encode(format_row(row))
+
+    @classmethod
+    def column_values(cls, values):
+        # request values converted to what the Core UPDATE binds, see Movie
+        return values
+
+    @classmethod
+    def stat_buckets(cls, row):
+        return []
+
+    @classmethod
+    def _record_write(cls, old, new):
+        StatBucket.move(
+            cls.__tablename__,
+            cls.stat_buckets(old) if old is not None else [],
+            cls.stat_buckets(new) if new is not None else []
+        )
+        invalidate_on_commit(db.session, cls.__tablename__)
+        if new is None:
+            refresh_on_commit(db.session, cls.__tablename__, old.id, old.version, None)
+            Change.record(cls.__tablename__, 'delete', old.id, old.version)
+        else:
+            fragment = cls.serializer()(new)
+            refresh_on_commit(db.session, cls.__tablename__, new.id, new.version, fragment)
+            Change.record(cls.__tablename__, 'create' if old is None else 'update',
+                          new.id, new.version, fragment)
+
+    @classmethod
+    def _record_inserts(cls, rows):
+        # _record_write(None, row) for many rows, one statement per bucket
+        # and one for the change log instead of a few per row
+        buckets = Counter(bucket for row in rows for bucket in set(cls.stat_buckets(row)))
+        for bucket, count in buckets.items():
+            StatBucket.adjust(cls.__tablename__, bucket, count)
+        invalidate_on_commit(db.session, cls.__tablename__)
+        serialize = cls.serializer()
+        changes = []
+        for row in rows:
+            fragment = serialize(row)
+            refresh_on_commit(db.session, cls.__tablename__, row.id, row.version, fragment)
+            changes.append((row.id, row.version, fragment))
+        Change.record_all(cls.__tablename__, 'create', changes)
+
+    def _previous_state(self):
+        # the committed values of stat_columns, taken from attribute history
+        previous = {}
+        for column in self.stat_columns:
+            history = get_history(self, column)
+            previous[column] = history.deleted[0] if history.deleted else getattr(self, column)
+        return SimpleNamespace(**previous)
+
+
+'''
+release_year(value) / age_bucket(age)
+    summary bucket labels
+'''
+
+
+def release_year(value):
+    return str(value.year)
+
+
+def age_bucket(age):
+    low = int(age) // 10 * 10
+    return '{}-{}'.format(low, low + 9)
 
 
 '''
 Movie
+    version is used as the optimistic concurrency token, every UPDATE is
+    issued as UPDATE ... WHERE id = ? AND version = ? and bumps the counter
 
 '''
 
 
-class Movie(db.Model):
+class Movie(CatalogueMixin, db.Model):
     __tablename__ = 'movies'
+    # never reuse the id of a deleted row, the row cache keys rows by id
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
     release_date = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    stat_columns = ('release_date',)
+    count_dimension = 'release_year'
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
-    def insert(self):
-        db.session.add(self)
-        db.session.commit()
+    @validates('release_date')
+    def parse_release_date(self, key, value):
+        # keep a datetime on the instance so writes record the stored value
+        if isinstance(value, str):
+            return parse_date(value)
+        return value
 
-    def update(self):
-        db.session.commit()
+    @classmethod
+    def column_values(cls, values):
+        # SQLite's DateTime only binds datetimes, PostgreSQL casts strings
+        if isinstance(values.get('release_date'), str):
+            values = dict(values, release_date=parse_date(values['release_date']))
+        return values
 
-    def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+    @classmethod
+    def stat_buckets(cls, row):
+        return [('release_year', release_year(row.release_date))]
 
     def format(self):
+        return self.format_row(self)
+
+    @staticmethod
+    def format_row(row):
         return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date,
+            'id': row.id,
+            'title': row.title,
+            'release_date': row.release_date,
         }
 
 
 '''
 Actor
+    version is used as the optimistic concurrency token, see Movie
+    (gender, age) is indexed for the casting match search
 
 '''
 
 
-class Actor(db.Model):
+class Actor(CatalogueMixin, db.Model):
     __tablename__ = 'actors'
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     gender = db.Column(db.String, nullable=False)
     age = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __table_args__ = (db.Index('ix_actors_gender_age', 'gender', 'age'), {'sqlite_autoincrement': True})
+    __mapper_args__ = {'version_id_col': version}
+
+    stat_columns = ('gender', 'age')
+    count_dimension = 'gender'
 
     def __init__(self, name, gender, age):
         self.name = name
         self.gender = gender
         self.age = age
 
+    @classmethod
+    def stat_buckets(cls, row):
+        return [('gender', row.gender), ('age', age_bucket(row.age))]
+
+    def format(self):
+        return self.format_row(self)
+
+    @staticmethod
+    def format_row(row):
+        return {
+            'id': row.id,
+            'name': row.name,
+            'gender': row.gender,
+            'age': row.age,
+        }
+
+
+'''
+IdempotencyKey
+    the first response stored per Idempotency-Key header and JWT subject
+    a row with a NULL status_code is still being processed, or its worker
+    died before releasing it, so it is only honoured until pending_before
+    and a later claim takes it over
+    request_hash guards against reusing one key for a different request
+
+'''
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = db.Column(db.String(255), primary_key=True)
+    subject = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+
+    @classmethod
+    def claim(cls, key, subject, request_hash, expires_before, pending_before):
+        """Reserves the key for the current request
+        returns None when the key was claimed, otherwise the record holding it
+        """
+        existing = cls.query.get((key, subject))
+        if existing is not None:
+            valid_after = pending_before if existing.status_code is None else expires_before
+            if existing.created_at >= valid_after:
+                return existing
+            db.session.delete(existing)
+            db.session.flush()
+
+        db.session.add(cls(key=key, subject=subject, request_hash=request_hash))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request with the same key won the insert
+            db.session.rollback()
+            return cls.query.get((key, subject)) or cls(key=key, subject=subject, request_hash=request_hash)
+        return None
+
+    @classmethod
+    def complete(cls, key, subject, status_code, body):
+        cls.query.filter_by(key=key, subject=subject).update({
+            'status_code': status_code,
+            'body': body,
+        })
+        db.session.commit()
+
+    @classmethod
+    def release(cls, key, subject):
+        db.session.rollback()
+        cls.query.filter_by(key=key, subject=subject, status_code=None).delete()
+        db.session.commit()
+
+    @classmethod
+    def purge(cls, expires_before):
+        count = cls.query.filter(cls.created_at < expires_before).delete()
+        db.session.commit()
+        return count
+
+
+'''
+StatBucket
+    incrementally maintained row counts behind GET /stats/actors and
+    GET /stats/movies, keyed by resource (table name), dimension and bucket
+    rebuild() recomputes every bucket from the base tables, blocking
+    movie and actor writes until it commits
+
+'''
+
+
+class StatBucket(db.Model):
+    __tablename__ = 'stat_buckets'
+
+    resource = db.Column(db.String(64), primary_key=True)
+    dimension = db.Column(db.String(64), primary_key=True)
+    bucket = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def move(cls, resource, old_buckets, new_buckets):
+        for bucket in set(old_buckets) - set(new_buckets):
+            cls.adjust(resource, bucket, -1)
+        for bucket in set(new_buckets) - set(old_buckets):
+            cls.adjust(resource, bucket, 1)
+
+    @classmethod
+    def adjust(cls, resource, bucket, delta):
+        dimension, bucket = bucket
+        query = cls.query.filter_by(resource=resource, dimension=dimension, bucket=bucket)
+        if query.update({'count': cls.count + delta}, synchronize_session=False):
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(resource=resource, dimension=dimension, bucket=bucket, count=delta))
+        except IntegrityError:
+            # a concurrent writer created the bucket first
+            query.update({'count': cls.count + delta}, synchronize_session=False)
+
+    @classmethod
+    def total(cls, resource, dimension):
+        # every row is counted in exactly one bucket of a dimension
+        return db.session.query(func.coalesce(func.sum(cls.count), 0)) \
+            .filter(cls.resource == resource, cls.dimension == dimension).scalar()
+
+    @classmethod
+    def summary(cls, resource, session=None):
+        summary = {}
+        rows = (session or db.session).query(cls).filter(cls.resource == resource, cls.count > 0).order_by(cls.dimension, cls.bucket)
+        for row in rows:
+            summary.setdefault(row.dimension, {})[row.bucket] = row.count
+        return summary
+
+    @classmethod
+    def rebuild(cls):
+        # writers adjust the buckets they touch, keep them out until the
+        # rebuilt counts commit or their increments land in between and are
+        # lost, a SHARE lock on PostgreSQL, on SQLite the write lock the
+        # DELETE takes before the counts are read
+        if db.session.get_bind().dialect.name == 'postgresql':
+            db.session.execute('LOCK TABLE movies, actors IN SHARE MODE')
+        cls.query.delete()
+
+        counts = {}
+        actors = db.session.query(Actor.gender, Actor.age, func.count()).group_by(Actor.gender, Actor.age)
+        for gender, age, count in actors:
+            for bucket in Actor.stat_buckets(SimpleNamespace(gender=gender, age=age)):
+                counts[('actors',) + bucket] = counts.get(('actors',) + bucket, 0) + count
+
+        year = extract('year', Movie.release_date)
+        for value, count in db.session.query(year, func.count()).group_by(year):
+            counts[('movies', 'release_year', str(int(value)))] = count
+
+        for (resource, dimension, bucket), count in counts.items():
+            db.session.add(cls(resource=resource, dimension=dimension, bucket=bucket, count=count))
+        db.session.commit()
+
+
+'''
+current_txid()
+    the id of the current transaction on PostgreSQL, recorded with each
+    change, 0 on SQLite
+'''
+
+
+def xid8(value):
+    # PostgreSQL has no cast from xid8 to bigint but through text
+    return cast(cast(value, db.Text), db.BigInteger)
+
+
+def current_txid():
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return xid8(func.pg_current_xact_id())
+    return 0
+
+
+'''
+Change
+    append-only change log behind GET /changes, one row per create, update
+    or delete of a movie or actor written in the same transaction as the
+    write itself, id is the cursor clients resume from
+    a delete is recorded as a tombstone without data, data is the row
+    already serialized by its model
+
+    readers page in (txid, id) order, txid being the writing transaction,
+    a serial id is drawn at INSERT and seen at COMMIT, so on PostgreSQL two
+    writers may commit out of id order, instead of serializing them readers
+    only see changes of transactions older than the oldest one still in
+    progress, every change committed later has a txid at least that high
+    and so sorts after any cursor already handed out
+    SQLite holds its single write lock from the first write of a
+    transaction until it ends, there txid is always 0 and ids are already
+    in commit order
+
+'''
+
+
+class Change(db.Model):
+    __tablename__ = 'changes'
+    __table_args__ = (db.Index('ix_changes_txid_id', 'txid', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(64), nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(16), nullable=False)
+    version = db.Column(db.Integer, nullable=True)
+    data = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    txid = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+    @classmethod
+    def record(cls, resource, operation, resource_id, version, data=None):
+        db.session.add(cls(
+            resource=resource,
+            operation=operation,
+            resource_id=resource_id,
+            version=version,
+            data=data,
+            txid=current_txid()
+        ))
+
+    @classmethod
+    def record_all(cls, resource, operation, changes):
+        # (resource_id, version, data) per change, in one INSERT
+        created_at = datetime.utcnow()
+        txid = current_txid()
+        db.session.execute(cls.__table__.insert().values([{
+            'resource': resource,
+            'operation': operation,
+            'resource_id': resource_id,
+            'version': version,
+            'data': data,
+            'created_at': created_at,
+            'txid': txid,
+        } for resource_id, version, data in changes]))
+
+    @classmethod
+    def position_of(cls, cursor, session=None):
+        # a cursor missing from the log sorts with the changes migrated in
+        txid = (session or db.session).query(cls.txid).filter(cls.id == cursor).scalar()
+        return (txid or 0, cursor)
+
+    @classmethod
+    def since(cls, cursor, resources, limit, session=None):
+        session = session or db.session
+        query = session.query(cls).filter(
+            tuple_(cls.txid, cls.id) > tuple_(*cls.position_of(cursor, session)),
+            cls.resource.in_(resources)
+        )
+        return cls.settled(query, session).order_by(cls.txid, cls.id).limit(limit).all()
+
+    @classmethod
+    def head(cls, session=None):
+        """Returns the cursor of the last change since() can return"""
+        session = session or db.session
+        query = cls.settled(session.query(cls.id), session)
+        return query.order_by(cls.txid.desc(), cls.id.desc()).limit(1).scalar() or 0
+
+    @classmethod
+    def settled(cls, query, session):
+        # leaves out transactions at or after the oldest still in progress
+        if session.get_bind().dialect.name == 'postgresql':
+            query = query.filter(cls.txid < xid8(func.pg_snapshot_xmin(func.pg_current_snapshot())))
+        return query
+
+    @property
+    def position(self):
+        return (self.txid, self.id)
+
+    def format(self):
+        return {
+            'cursor': self.id,
+            'resource': self.resource,
+            'id': self.resource_id,
+            'operation': self.operation,
+            'version': self.version,
+            'data': flask_json.loads(self.data) if self.data is not None else None,
+            'created_at': self.created_at,
+        }
+
+
+'''
+Job
+    queue of long-running bulk operations behind POST /jobs, run by the
+    worker processes started with `python manage.py worker`
+    status moves from queued to running to succeeded or failed, updated_at
+    doubles as the heartbeat of the worker running the job
+
+'''
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=True)
+    subject = db.Column(db.String(255), nullable=True)
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    worker = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime(), nullable=True)
+    finished_at = db.Column(db.DateTime(), nullable=True)
+
+    def __init__(self, kind, payload, subject):
+        self.kind = kind
+        self.payload = flask_json.dumps(payload)
+        self.subject = subject
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
 
-    def update(self):
+    @classmethod
+    def claim(cls, worker):
+        """Marks the oldest queued job as running and returns it
+        SKIP LOCKED lets several workers claim concurrently without waiting
+        """
+        job = cls.query.filter_by(status='queued').order_by(cls.id) \
+            .with_for_update(skip_locked=True).first()
+        if job is None:
+            db.session.rollback()
+            return None
+        job.status = 'running'
+        job.worker = worker
+        job.started_at = job.updated_at = datetime.utcnow()
         db.session.commit()
+        return job
 
-    def delete(self):
-        db.session.delete(self)
+    @classmethod
+    def requeue_stale(cls, updated_before):
+        count = cls.query.filter(cls.status == 'running', cls.updated_at < updated_before) \
+            .update({'status': 'queued', 'worker': None}, synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def report_progress(self, progress):
+        self.progress = progress
+        self.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def finish(self, result=None, error=None):
+        self.status = 'failed' if error is not None else 'succeeded'
+        self.progress = self.progress if error is not None else 100
+        self.result = flask_json.dumps(result) if result is not None else None
+        self.error = error
+        self.finished_at = self.updated_at = datetime.utcnow()
         db.session.commit()
 
     def format(self):
         return {
             'id': self.id,
-            'name': self.name,
-            'gender': self.gender,
-            'age': self.age,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'result': flask_json.loads(self.result) if self.result is not None else None,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
         }
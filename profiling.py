@@ -0,0 +1,136 @@
+import cProfile
+import itertools
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from flask import request, abort, g
+from auth import get_token_auth_header, verified_payload, check_permissions
+
+PROFILE_PERMISSION = 'profile:requests'
+PROFILE_HEADER = 'X-Profile'
+PROFILE_OUTPUT_HEADER = 'X-Profile-Output'
+PROFILERS = ('cprofile', 'sample')
+# in the app instance folder unless PROFILE_DIR is set
+DEFAULT_DIR = 'profiles'
+
+'''
+StackSampler
+    sampling profiler for one thread, every interval it records the thread's
+    current stack, collapsed() renders the counts in the folded format
+    flamegraph.pl and speedscope read ("outer;inner count" per line)
+'''
+
+
+class StackSampler(object):
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+
+    def enable(self):
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack and not self.stopped.is_set():
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self.counts.most_common())
+
+
+'''
+setup_profiling(app)
+    on-demand profiling of single requests, normal requests only pay for
+    a header lookup
+
+    a request with the X-Profile header (cprofile or sample) and a token
+    holding the 'profile:requests' permission runs under that profiler
+    the response body is replaced with the profile, pstats data for cprofile
+    or collapsed stacks for sample, unless X-Profile-Output is "file", then
+    the profile is saved to PROFILE_DIR and named in the X-Profile-File
+    header of the untouched response
+
+    PROFILE_DIR and the profiles in it are created private to the user
+
+    PROFILE_SAMPLE_EVERY = N also profiles every Nth request of each route
+    with cProfile into PROFILE_DIR (0 disables sampling)
+    PROFILE_SAMPLE_INTERVAL is the stack sampler period in seconds (0.001)
+'''
+
+
+def setup_profiling(app):
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, DEFAULT_DIR))
+    app.config.setdefault('PROFILE_SAMPLE_EVERY', 0)
+    app.config.setdefault('PROFILE_SAMPLE_INTERVAL', 0.001)
+    counters = {}
+
+    @app.before_request
+    def start_profiler():
+        profiler = request.headers.get(PROFILE_HEADER)
+        every = app.config['PROFILE_SAMPLE_EVERY']
+        if profiler is None and not every:
+            return
+
+        if profiler is not None:
+            check_permissions(PROFILE_PERMISSION, verified_payload(get_token_auth_header()))
+            if profiler not in PROFILERS:
+                abort(400)
+            output = request.headers.get(PROFILE_OUTPUT_HEADER, 'response')
+        else:
+            counter = counters.setdefault(request.endpoint, itertools.count(1))
+            if next(counter) % every:
+                return
+            profiler, output = 'cprofile', 'file'
+
+        if profiler == 'sample':
+            g.profiler = StackSampler(threading.get_ident(), app.config['PROFILE_SAMPLE_INTERVAL'])
+        else:
+            g.profiler = cProfile.Profile()
+        g.profile_output = output
+        g.profiler.enable()
+
+    @app.after_request
+    def finish_profiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+
+        if isinstance(profiler, StackSampler):
+            data, mimetype, extension = profiler.collapsed().encode(), 'text/plain', 'collapsed'
+        else:
+            profiler.create_stats()
+            data, mimetype, extension = marshal.dumps(profiler.stats), 'application/octet-stream', 'pstats'
+
+        if g.pop('profile_output') == 'file':
+            filename = '{}-{}-{}.{}'.format(request.endpoint, int(time.time() * 1000), os.getpid(), extension)
+            os.makedirs(app.config['PROFILE_DIR'], mode=0o700, exist_ok=True)
+            # O_EXCL and O_NOFOLLOW, never write through a planted file or symlink
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+            fd = os.open(os.path.join(app.config['PROFILE_DIR'], filename), flags, 0o600)
+            with open(fd, 'wb') as profile_file:
+                profile_file.write(data)
+            response.headers['X-Profile-File'] = filename
+            return response
+
+        profiled = app.response_class(data, mimetype=mimetype)
+        profiled.headers['X-Profile-Status'] = str(response.status_code)
+        profiled.headers['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(request.endpoint, extension)
+        return profiled
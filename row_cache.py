@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+DEFAULT_SIZE = 100000
+
+'''
+RowCache
+    bounded LRU of serialized rows, the JSON fragment of each movie or actor
+    keyed by (resource, id) and valid only for the version it was built from,
+    so a row rewritten by another worker (every write bumps version) is
+    serialized again on its next read instead of being served stale
+
+    join(resource, rows, serialize) builds a JSON array from the fragments,
+    serializing only rows missing from the cache
+    hits and misses count rows served from and added to the cache
+'''
+
+
+class RowCache(object):
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            self._evict()
+
+    def put(self, resource, id, version, fragment):
+        with self.lock:
+            self._store((resource, id), version, fragment)
+
+    def discard(self, resource, id):
+        with self.lock:
+            self.entries.pop((resource, id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def join(self, resource, rows, serialize):
+        fragments = []
+        missing = []
+        with self.lock:
+            entries = self.entries
+            for row in rows:
+                key = (resource, row.id)
+                entry = entries.get(key)
+                if entry is not None and entry[0] == row.version:
+                    entries.move_to_end(key)
+                    fragments.append(entry[1])
+                else:
+                    missing.append(len(fragments))
+                    fragments.append(row)
+            self.hits += len(fragments) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            # serialize outside the lock, other requests keep reading
+            for index in missing:
+                row = fragments[index]
+                fragments[index] = (row, serialize(row))
+            with self.lock:
+                for index in missing:
+                    row, fragment = fragments[index]
+                    self._store((resource, row.id), row.version, fragment)
+                    fragments[index] = fragment
+        return '[' + ','.join(fragments) + ']'
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _store(self, key, version, fragment):
+        if self.size <= 0:
+            return
+        self.entries[key] = (version, fragment)
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+rows = RowCache()
+
+'''
+refresh_on_commit(session, resource, id, version, fragment)
+    called from the model write methods with the row's new fragment, or
+    None for a delete, the cache is updated once the outermost transaction
+    commits so a rolled back write never leaves its fragment behind
+'''
+
+
+def refresh_on_commit(session, resource, id, version, fragment):
+    session.info.setdefault('row_fragments', {})[(resource, id)] = (version, fragment)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def refresh_committed_rows(session):
+    # releasing a SAVEPOINT fires after_commit too, wait for the real commit
+    if session.transaction is not None and session.transaction.nested:
+        return
+    fragments = session.info.pop('row_fragments', None)
+    for (resource, id), (version, fragment) in (fragments or {}).items():
+        if fragment is None:
+            rows.discard(resource, id)
+        else:
+            rows.put(resource, id, version, fragment)
+
+
+@event.listens_for(SignallingSession, 'after_transaction_end')
+def discard_rolled_back_rows(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('row_fragments', None)
+
+
+'''
+setup_row_cache(app)
+    ROW_CACHE_SIZE bounds the fragments kept per worker (DEFAULT_SIZE),
+    0 disables the cache
+'''
+
+
+def setup_row_cache(app):
+    size = app.config.setdefault('ROW_CACHE_SIZE', DEFAULT_SIZE)
+    if size != rows.size:
+        rows.resize(size)
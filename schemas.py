@@ -0,0 +1,180 @@
+from datetime import timezone
+from functools import wraps
+from dateutil.parser import parse as parse_date
+from flask import request, abort
+from casting import MAX_AGE
+
+MAX_ROWS = 100000
+MAX_ID = 2 ** 31 - 1
+
+'''
+Request schemas
+    each field type below returns a check(value) that returns the value
+    converted for the models or raises Invalid, obj() combines checks into
+    a check for a JSON object, schemas are built once when this module is
+    imported and validate a body in memory without touching the database
+
+    errors are (path, message) pairs, paths name the field ("age") and, in
+    nested bodies, where it sits ("rows[3].age")
+'''
+
+
+class Invalid(Exception):
+
+    def __init__(self, message=None, errors=None):
+        super().__init__(message)
+        self.errors = errors if errors is not None else [('', message)]
+
+    def within(self, name):
+        return [(join_path(name, path), message) for path, message in self.errors]
+
+
+def join_path(name, path):
+    if not path:
+        return name
+    return name + path if path.startswith('[') else name + '.' + path
+
+
+def string(min_length=1, max_length=255):
+    def check(value):
+        if not isinstance(value, str):
+            raise Invalid('must be a string')
+        if not min_length <= len(value) <= max_length:
+            raise Invalid('must be {} to {} characters long'.format(min_length, max_length))
+        return value
+    return check
+
+
+def integer(minimum, maximum):
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise Invalid('must be an integer')
+        if not minimum <= value <= maximum:
+            raise Invalid('must be between {} and {}'.format(minimum, maximum))
+        return value
+    return check
+
+
+def date():
+    def check(value):
+        if not isinstance(value, str) or len(value) > 64:
+            raise Invalid('must be a date string')
+        try:
+            parsed = parse_date(value)
+        except (ValueError, OverflowError):
+            raise Invalid('must be a date such as 2021-12-22')
+        # release dates are stored without a time zone, in UTC
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    return check
+
+
+def list_of(item, max_items=MAX_ROWS):
+    def check(value):
+        if not isinstance(value, list):
+            raise Invalid('must be a list')
+        if len(value) > max_items:
+            raise Invalid('must have at most {} items'.format(max_items))
+        values = []
+        errors = []
+        for index, entry in enumerate(value):
+            try:
+                values.append(item(entry))
+            except Invalid as error:
+                errors.extend(error.within('[{}]'.format(index)))
+        if errors:
+            raise Invalid(errors=errors)
+        return values
+    return check
+
+
+'''
+obj(fields, required=())
+    check for a JSON object with the given fields, unknown fields are
+    rejected, a null field counts as absent so PATCH bodies may leave any
+    field out while fields in required must be present and not null
+'''
+
+
+def obj(fields, required=()):
+    items = tuple(fields.items())
+    known = frozenset(fields)
+
+    def check(value):
+        if not isinstance(value, dict):
+            raise Invalid('must be an object')
+        errors = [(name, 'is required') for name in required if value.get(name) is None]
+        errors.extend((name, 'is not a known field') for name in value if name not in known)
+        values = {}
+        for name, field in items:
+            if value.get(name) is None:
+                continue
+            try:
+                values[name] = field(value[name])
+            except Invalid as error:
+                errors.extend(error.within(name))
+        if errors:
+            raise Invalid(errors=errors)
+        return values
+    return check
+
+
+MOVIE_FIELDS = {
+    'title': string(1, 255),
+    'release_date': date(),
+}
+
+ACTOR_FIELDS = {
+    'name': string(1, 255),
+    'gender': string(1, 64),
+    'age': integer(0, MAX_AGE),
+}
+
+movie_create = obj(MOVIE_FIELDS, required=('title', 'release_date'))
+movie_update = obj(MOVIE_FIELDS)
+actor_create = obj(ACTOR_FIELDS, required=('name', 'gender', 'age'))
+actor_update = obj(ACTOR_FIELDS)
+
+movie_rows = obj({'rows': list_of(movie_create)}, required=('rows',))
+actor_rows = obj({'rows': list_of(actor_create)}, required=('rows',))
+row_ids = obj({'ids': list_of(integer(1, MAX_ID))}, required=('ids',))
+no_payload = obj({})
+
+'''
+validate(schema, body, name='')
+    returns the converted body, or aborts with 422 and the errors as
+    [{"field": path, "message": message}, ...], name prefixes the paths
+    when body is nested in the request body
+'''
+
+
+def validate(schema, body, name=''):
+    try:
+        return schema(body)
+    except Invalid as error:
+        errors = error.within(name) if name else error.errors
+        abort(422, [{'field': path, 'message': message} for path, message in errors])
+
+
+'''
+@validated(schema) decorator
+    must be applied below @requires_auth and above @idempotent, so a bad
+    body is rejected before an idempotency key or a connection is taken
+    it should respond with a 400 error if the body is not a JSON object
+    and with a 422 error listing every invalid field otherwise
+    passes the converted body to the decorated method as body
+'''
+
+
+def validated(schema):
+    def validated_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            body = request.get_json(silent=True)
+            if not isinstance(body, dict):
+                abort(400, [{'field': '', 'message': 'the body must be a JSON object'}])
+            return f(*args, body=validate(schema, body), **kwargs)
+
+        return wrapper
+    return validated_decorator
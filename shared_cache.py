@@ -0,0 +1,253 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+from flask import request, current_app, make_response
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# in the app instance folder unless SHARED_CACHE_PATH is set
+DEFAULT_FILE = 'shared-cache.sqlite3'
+RESPONSE_TTL = 300
+PURGE_SECONDS = 60
+CACHED_HEADERS = ('ETag', 'X-Total-Count', 'X-Total-Count-Estimated')
+# set in the WSGI environ of every POST /batch sub-request, see batch.py
+SUBREQUEST_KEY = 'casting.batch_subrequest'
+
+'''
+SharedCache
+    key/value cache shared by every worker process on a host, stored in a
+    SQLite file in WAL mode so readers never block the writer
+    entries may carry a tag ('movies', 'actors'), invalidate(tag) bumps the
+    tag's generation and every entry stored under an older generation is
+    ignored from then on, so a write in one worker is seen by all workers
+    on their next lookup without any message passing
+
+    callers read generation(tag) before loading the value they store, so a
+    value loaded before a concurrent invalidation is never served after it
+    cache errors are logged and treated as misses
+
+    expired entries are only skipped by lookups, set() deletes them at most
+    once every PURGE_SECONDS per process, through the expires_at index
+
+    the file holds the JWKS and verified token payloads that auth.py
+    trusts, it is created with mode 0600 and refused, every lookup a miss,
+    unless it is owned by the current user and closed to group and others
+'''
+
+
+class SharedCache(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.local = threading.local()
+        self.purged_at = time.time()
+
+    def configure(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.purged_at = time.time()
+
+    @property
+    def connection(self):
+        # one connection per thread and process, workers fork after import
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            check_private(self.path)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, '
+                'tag TEXT, generation INTEGER)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS generations ('
+                'tag TEXT PRIMARY KEY, generation INTEGER NOT NULL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        try:
+            row = self.connection.execute(
+                'SELECT e.value FROM entries e LEFT JOIN generations g ON g.tag = e.tag '
+                'WHERE e.key = ? AND e.expires_at > ? '
+                'AND (e.tag IS NULL OR e.generation = COALESCE(g.generation, 0))',
+                (key, time.time())).fetchone()
+        except sqlite3.Error:
+            logger.exception('shared cache lookup failed')
+            return None
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, key, value, ttl, tag=None, generation=None):
+        try:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries (key, value, expires_at, tag, generation) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, json.dumps(value), time.time() + ttl, tag, generation))
+        except sqlite3.Error:
+            logger.exception('shared cache store failed')
+        if time.time() - self.purged_at >= PURGE_SECONDS:
+            self.purge()
+
+    def purge(self):
+        self.purged_at = time.time()
+        try:
+            self.connection.execute('DELETE FROM entries WHERE expires_at <= ?', (self.purged_at,))
+        except sqlite3.Error:
+            logger.exception('shared cache purge failed')
+
+    def generation(self, tag):
+        try:
+            row = self.connection.execute(
+                'SELECT generation FROM generations WHERE tag = ?', (tag,)).fetchone()
+        except sqlite3.Error:
+            logger.exception('shared cache lookup failed')
+            return None
+        return row[0] if row is not None else 0
+
+    def invalidate(self, *tags):
+        try:
+            with self.connection:
+                for tag in tags:
+                    self.connection.execute(
+                        'INSERT INTO generations (tag, generation) VALUES (?, 1) '
+                        'ON CONFLICT (tag) DO UPDATE SET generation = generation + 1', (tag,))
+        except sqlite3.Error:
+            logger.exception('shared cache invalidation failed')
+
+    def clear(self):
+        try:
+            with self.connection:
+                self.connection.execute('DELETE FROM entries')
+                self.connection.execute('UPDATE generations SET generation = generation + 1')
+        except sqlite3.Error:
+            logger.exception('shared cache clear failed')
+
+
+def check_private(path):
+    if path is None:
+        raise sqlite3.OperationalError('the shared cache has no path, see setup_shared_cache()')
+    # O_NOFOLLOW, a planted symlink must not redirect the file
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    try:
+        stat = os.fstat(fd)
+    finally:
+        os.close(fd)
+    if stat.st_uid != os.geteuid() or stat.st_mode & 0o077:
+        raise sqlite3.OperationalError(
+            'refusing shared cache {}, it must be owned by uid {} with mode 0600'.format(path, os.geteuid()))
+
+
+cache = SharedCache(os.environ.get('SHARED_CACHE_PATH'))
+
+'''
+invalidate_on_commit(tag)
+    called from the model write methods inside a transaction, the tag is
+    invalidated once the outermost transaction commits and dropped if it
+    rolls back
+'''
+
+
+def invalidate_on_commit(session, tag):
+    session.info.setdefault('invalidate_tags', set()).add(tag)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_committed_tags(session):
+    # releasing a SAVEPOINT fires after_commit too, wait for the real commit
+    if session.transaction is not None and session.transaction.nested:
+        return
+    tags = session.info.pop('invalidate_tags', None)
+    if tags:
+        cache.invalidate(*tags)
+
+
+@event.listens_for(SignallingSession, 'after_transaction_end')
+def discard_rolled_back_tags(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('invalidate_tags', None)
+
+
+'''
+reads_uncommitted()
+    True inside a POST /batch sub-request or a SAVEPOINT, where the session
+    may see writes of an atomic batch that can still roll back, together
+    with the invalidations they would have caused, so nothing read there
+    may be cached or shared with other requests
+'''
+
+
+def reads_uncommitted():
+    if request.environ.get(SUBREQUEST_KEY):
+        return True
+    session = current_app.extensions['sqlalchemy'].db.session()
+    return session.transaction is not None and session.transaction.nested
+
+
+'''
+setup_shared_cache(app)
+    points the cache at SHARED_CACHE_PATH (DEFAULT_FILE in the app instance
+    folder by default, created private to the user), every worker of a
+    host must use the same path
+'''
+
+
+def setup_shared_cache(app):
+    path = app.config.setdefault('SHARED_CACHE_PATH', cache.path)
+    if path is None:
+        os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+        path = app.config['SHARED_CACHE_PATH'] = os.path.join(app.instance_path, DEFAULT_FILE)
+    if path != cache.path:
+        cache.configure(path)
+
+
+'''
+@cached_response(tag) decorator
+    must be applied below @requires_auth so permissions are checked before
+    a cached body is served, caches 200 responses of GET routes by path and
+    query string for RESPONSE_CACHE_TTL seconds (RESPONSE_TTL) under tag,
+    with the body and CACHED_HEADERS, a TTL of 0 disables response caching
+    batch sub-requests bypass the cache, see reads_uncommitted()
+'''
+
+
+def cached_response(tag):
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            ttl = current_app.config.get('RESPONSE_CACHE_TTL', RESPONSE_TTL)
+            if ttl <= 0 or reads_uncommitted():
+                return f(*args, **kwargs)
+
+            key = 'response:' + request.full_path
+            cached = cache.get(key)
+            if cached is not None:
+                response = current_app.response_class(cached['body'], mimetype='application/json')
+                response.headers.extend(cached.get('headers', {}))
+                return response
+
+            generation = cache.generation(tag)
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and generation is not None:
+                cache.set(key, {
+                    'body': response.get_data(as_text=True),
+                    'headers': {name: response.headers[name] for name in CACHED_HEADERS
+                                if name in response.headers},
+                }, ttl, tag, generation)
+            return response
+
+        return wrapper
+    return cached_response_decorator
+
+
+def token_key(token, scope):
+    return 'jwt:' + hashlib.sha256((scope + '\n' + token).encode()).hexdigest()
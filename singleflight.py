@@ -0,0 +1,99 @@
+import threading
+from functools import wraps
+from flask import request, current_app, make_response
+from shared_cache import reads_uncommitted
+
+FOLLOWER_TIMEOUT = 10
+
+'''
+SingleFlight
+    deduplicates identical concurrent calls within a process, the first
+    caller for a key (the leader) runs the call and every caller arriving
+    while it is in flight waits for and shares its result or exception
+    a follower that waits longer than FOLLOWER_TIMEOUT runs the call itself
+
+    leaders counts calls that ran, coalesced counts calls that were shared
+'''
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if call.done.wait(FOLLOWER_TIMEOUT):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            return fn()
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls),
+            }
+
+
+class Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+flight = SingleFlight()
+
+'''
+@coalesced(scope) decorator
+    must be applied below @requires_auth, identical GET requests (same path
+    and query string) of the same permission scope that arrive while one is
+    being served share its database load, serialization and response bytes
+    disabled with SINGLEFLIGHT_ENABLED = False, batch sub-requests never
+    lead or follow a flight, see shared_cache.reads_uncommitted()
+'''
+
+
+def coalesced(scope):
+    def coalesced_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('SINGLEFLIGHT_ENABLED', True) or reads_uncommitted():
+                return f(*args, **kwargs)
+
+            def load():
+                response = make_response(f(*args, **kwargs))
+                return response.get_data(), response.status_code, list(response.headers)
+
+            body, status, headers = flight.do((scope, request.full_path), load)
+            return current_app.response_class(body, status=status, headers=headers)
+
+        return wrapper
+    return coalesced_decorator
@@ -1,11 +1,23 @@
 
 import os
+import gzip
+import pstats
+import tempfile
+import threading
+import time
 import unittest
 import json
+from datetime import datetime, timedelta
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
 
 from app import create_app
-from models import setup_db, db, Movie, Actor, db_drop_and_create_all
+from models import setup_db, db, Movie, Actor, Change, StatBucket, IdempotencyKey, db_drop_and_create_all
+from jobs import run_next
+from group_commit import group
+from singleflight import flight
+from shared_cache import SharedCache
+from casting import ActorIndex
 
 
 casting_assistant_jwt = "Bearer {}".format(os.environ.get('CASTING_ASSISTANT_JWT'))
@@ -74,6 +86,26 @@ class CastingAgencyTestCase(unittest.TestCase):
     and for expected errors.
     """
 
+    """
+    Test health endpoints
+    """
+    def test_healthz(self):
+        res = self.client().get('/healthz')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['status'], 'alive')
+
+    def test_readyz_after_warm_up(self):
+        self.app.config['WARM_UP_JWKS'] = False
+        res = self.client().get('/readyz')
+        data = json.loads(res.data)
+
+        # check every warm-up step has passed
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(all(data['checks'].values()))
+
     """
     Test API endpoint for actors
     """
@@ -88,6 +120,76 @@ class CastingAgencyTestCase(unittest.TestCase):
 
         self.assertTrue(data['actor'])
 
+    def test_post_actors_group_commit(self):
+        self.app.config['GROUP_COMMIT_ENABLED'] = True
+        self.app.config['GROUP_COMMIT_WINDOW_MS'] = 200
+        self.app.config['GROUP_COMMIT_MAX_ROWS'] = 4
+        groups = group.stats()['groups']
+        responses = []
+
+        def post(age):
+            actor = dict(self.new_actor_1, age=age)
+            responses.append(self.client().post('/actors', json=actor, headers={"Authorization": (casting_director_jwt)}))
+
+        threads = [threading.Thread(target=post, args=(age,)) for age in range(20, 28)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        actors = [json.loads(res.data)['actor'] for res in responses]
+
+        # each request gets its own row, committed in fewer transactions
+        self.assertEqual([res.status_code for res in responses], [200] * 8)
+        self.assertEqual(sorted(actor['id'] for actor in actors), list(range(1, 9)))
+        with self.app.app_context():
+            self.assertTrue(all(actor['age'] == Actor.query.get(actor['id']).age for actor in actors))
+        self.assertLess(group.stats()['groups'] - groups, 8)
+
+    def test_post_actors_replays_idempotency_key(self):
+        headers = {"Authorization": (casting_director_jwt), "Idempotency-Key": "actor-retry-1"}
+        first = self.client().post('/actors', json=self.new_actor_1, headers=headers)
+        res = self.client().post('/actors', json=self.new_actor_1, headers=headers)
+        data = json.loads(res.data)
+
+        # check status and that the retry did not create a second actor
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(data, json.loads(first.data))
+
+        res = self.client().get('/actors', headers={"Authorization": (casting_director_jwt)})
+        self.assertEqual(len(json.loads(res.data)['actors']), 1)
+
+    def test_post_actors_takes_over_abandoned_idempotency_key(self):
+        headers = {"Authorization": (casting_director_jwt), "Idempotency-Key": "actor-retry-3"}
+        self.client().post('/actors', json=self.new_actor_1, headers=headers)
+
+        # leave the key as a worker killed mid-request would, still pending
+        # an hour later, and drop the actor its request never committed
+        with self.app.app_context():
+            record = IdempotencyKey.query.filter_by(key="actor-retry-3").one()
+            record.status_code = None
+            record.body = None
+            record.created_at = datetime.utcnow() - timedelta(hours=1)
+            Actor.query.delete()
+            db.session.commit()
+
+        res = self.client().post('/actors', json=self.new_actor_1, headers=headers)
+
+        # check the retry ran the request instead of waiting out the key ttl
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+        res = self.client().get('/actors', headers={"Authorization": (casting_director_jwt)})
+        self.assertEqual(len(json.loads(res.data)['actors']), 1)
+
+    def test_422_post_actors_reused_idempotency_key(self):
+        headers = {"Authorization": (casting_director_jwt), "Idempotency-Key": "actor-retry-2"}
+        res = self.client().post('/actors', json=self.new_actor_1, headers=headers)
+        res = self.client().post('/actors', json=self.new_actor_2, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
     def test_get_actors(self):
         res = self.client().get('/actors', headers={"Authorization": (casting_assistant_jwt)})
         data = json.loads(res.data)
@@ -98,6 +200,72 @@ class CastingAgencyTestCase(unittest.TestCase):
 
         self.assertTrue(len(data['actors']) >= 0)
 
+    def test_get_actors_page_with_total(self):
+        for actor in (self.new_actor_1, self.new_actor_2, self.update_actor):
+            res = self.client().post('/actors', json=actor, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/actors?limit=2', headers={"Authorization": (casting_assistant_jwt)})
+        res = self.client().get('/actors?limit=2', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # the cached page keeps its total header
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 2])
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(res.headers['X-Total-Count'], '3')
+
+        res = self.client().get('/actors?after=2&count=estimate', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual([actor['id'] for actor in data['actors']], [3])
+        self.assertEqual(res.headers['X-Total-Count'], '3')
+        self.assertEqual(res.headers['X-Total-Count-Estimated'], 'true')
+
+    def test_get_actors_coalesces_concurrent_requests(self):
+        self.app.config['RESPONSE_CACHE_TTL'] = 0
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        followers = 3
+        before = flight.stats()
+        page_json = Actor.page_json
+
+        def slow_page_json(*args):
+            # hold the leader until every other request waits on its flight
+            deadline = time.time() + 5
+            while flight.stats()['coalesced'] - before['coalesced'] < followers and time.time() < deadline:
+                time.sleep(0.01)
+            return page_json(*args)
+
+        responses = []
+
+        def get_actors():
+            res = self.client().get('/actors', headers={"Authorization": (casting_assistant_jwt)})
+            responses.append((res.status_code, res.data))
+
+        with mock.patch.object(Actor, 'page_json', slow_page_json):
+            clients = [threading.Thread(target=get_actors) for _ in range(followers + 1)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join(10)
+
+        # one request loaded the page, the others shared its response
+        after = flight.stats()
+        self.assertEqual(after['leaders'] - before['leaders'], 1)
+        self.assertEqual(after['coalesced'] - before['coalesced'], followers)
+        self.assertEqual(len(responses), followers + 1)
+        self.assertEqual(len(set(responses)), 1)
+        self.assertEqual(responses[0][0], 200)
+        self.assertEqual(len(json.loads(responses[0][1])['actors']), 1)
+
+    def test_get_actors_after_write_is_not_stale(self):
+        res = self.client().get('/actors', headers={"Authorization": (casting_assistant_jwt)})
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (casting_director_jwt)})
+        res = self.client().get('/actors', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # the write invalidated the cached collection
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+
     def test_patch_actors(self):
         res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
         res = self.client().patch('/actors/1', json=self.update_actor, headers={"Authorization": (executive_producer_jwt)})
@@ -109,6 +277,18 @@ class CastingAgencyTestCase(unittest.TestCase):
 
         self.assertTrue(len(data['actor']) == 1)
 
+    def test_get_actors_after_patch_is_not_stale(self):
+        self.app.config['RESPONSE_CACHE_TTL'] = 0
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/actors', headers={"Authorization": (casting_assistant_jwt)})
+        res = self.client().patch('/actors/1', json=self.update_actor, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/actors', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # the patch refreshed the actor's serialized row
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][0]['age'], self.update_actor['age'])
+
     def test_delete_actors(self):
         res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
         res = self.client().post('/actors', json=self.new_actor_2, headers={"Authorization": (executive_producer_jwt)})
@@ -121,6 +301,100 @@ class CastingAgencyTestCase(unittest.TestCase):
 
         self.assertTrue(data['delete'] == 2)
 
+    def test_post_actors_after_delete_gets_new_id(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/actors/1', headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().delete('/actors/1', headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().post('/actors', json=self.new_actor_2, headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        # the deleted id is not reused, so the row cache cannot serve it
+        self.assertEqual(data['actor']['id'], 2)
+        res = self.client().get('/actors/1', headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(res.status_code, 404)
+
+    def test_concurrent_patch_and_delete_actors(self):
+        for number in range(20):
+            res = self.client().post('/actors', json=dict(self.new_actor_1, age=20 + number),
+                                     headers={"Authorization": (executive_producer_jwt)})
+        statuses = []
+
+        def patch_actors():
+            for id in range(1, 21, 2):
+                res = self.client().patch('/actors/{}'.format(id), json={'age': 60},
+                                          headers={"Authorization": (executive_producer_jwt)})
+                statuses.append(res.status_code)
+
+        def delete_actors():
+            for id in range(2, 21, 2):
+                res = self.client().delete('/actors/{}'.format(id), headers={"Authorization": (executive_producer_jwt)})
+                statuses.append(res.status_code)
+
+        writers = [threading.Thread(target=patch_actors), threading.Thread(target=delete_actors)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join(30)
+
+        # writers that read before they write wait for each other instead of failing
+        self.assertEqual(statuses, [200] * 20)
+        res = self.client().get('/stats/actors', headers={"Authorization": (casting_assistant_jwt)})
+        self.assertEqual(json.loads(res.data)['age'], {'60-69': 10})
+
+    def test_get_actor_stats(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().post('/actors', json=self.new_actor_2, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/actors/2', json=self.update_actor, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().delete('/actors/1', headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/stats/actors', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # check status and the incrementally maintained counts
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['gender'], {'female': 1})
+        self.assertEqual(data['age'], {'20-29': 1})
+
+    def test_rebuild_actor_stats(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().post('/actors', json=self.new_actor_2, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/actors/2', json=self.update_actor, headers={"Authorization": (executive_producer_jwt)})
+        with self.app.app_context():
+            before = StatBucket.summary('actors')
+            StatBucket.rebuild()
+            # the rebuilt counts match the incrementally maintained ones
+            self.assertEqual(StatBucket.summary('actors'), before)
+            db.session.remove()
+
+    def test_match_actors(self):
+        for name, gender, age in (('A', 'female', 24), ('B', 'female', 31), ('C', 'male', 30),
+                                  ('D', 'female', 29), ('E', 'female', 45), ('F', 'female', 31)):
+            res = self.client().post('/actors', json={'name': name, 'gender': gender, 'age': age},
+                                     headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/actors/6', json={'age': 40}, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/actors/match?gender=female&age_min=20&age_max=40&exclude=1&limit=2',
+                                headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # ranked by distance from the middle of the band (30), limited to 2
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total'], 3)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['D', 'B'])
+
+    def test_get_actors_gzip(self):
+        self.app.config['COMPRESS_MIN_SIZE'] = 0
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/actors', headers={"Authorization": (casting_assistant_jwt), "Accept-Encoding": "gzip"})
+        data = json.loads(gzip.decompress(res.data))
+
+        # check the negotiated encoding and the decompressed body
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(data['actors'][0]['name'], 'Gal Gadot')
+
     """
     Test API endpoint for movies
     """
@@ -167,6 +441,299 @@ class CastingAgencyTestCase(unittest.TestCase):
 
         self.assertTrue(data['delete'] == 2)
 
+    def test_patch_actors_with_matching_if_match(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/actors/1', headers={"Authorization": (executive_producer_jwt)})
+        etag = res.headers['ETag']
+        res = self.client().patch('/actors/1', json=self.update_actor, headers={"Authorization": (executive_producer_jwt), "If-Match": etag})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_movie_stats(self):
+        res = self.client().post('/movies', json=self.new_movie_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().post('/movies', json=self.new_movie_2, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/stats/movies', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # check status and the incrementally maintained counts
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total'], 2)
+        self.assertEqual(data['release_year'], {'2021': 2})
+
+    """
+    Test API endpoint for the change feed
+    """
+    def test_get_changes(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/actors/1', json=self.update_actor, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().delete('/actors/1', headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/changes?since=0&limit=2', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # check status, ordering and paging
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([change['operation'] for change in data['changes']], ['create', 'update'])
+        self.assertEqual(data['changes'][1]['data']['age'], 28)
+        self.assertTrue(data['has_more'])
+
+        res = self.client().get('/changes?since={}'.format(data['next']), headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # the delete is a tombstone
+        self.assertEqual(len(data['changes']), 1)
+        self.assertEqual(data['changes'][0]['operation'], 'delete')
+        self.assertIsNone(data['changes'][0]['data'])
+        self.assertFalse(data['has_more'])
+
+    def test_changes_commit_in_id_order(self):
+        first_written = threading.Event()
+        second_started = threading.Event()
+        commits = []
+
+        def first_writer():
+            with self.app.app_context():
+                Change.record('actors', 'create', 1, 1)
+                db.session.flush()
+                first_written.set()
+                second_started.wait(5)
+                # give the second writer time to try to commit first
+                time.sleep(0.2)
+                db.session.commit()
+                commits.append(1)
+                db.session.remove()
+
+        def second_writer():
+            first_written.wait(5)
+            with self.app.app_context():
+                second_started.set()
+                Change.record('actors', 'create', 2, 1)
+                db.session.commit()
+                commits.append(2)
+                db.session.remove()
+
+        writers = [threading.Thread(target=first_writer), threading.Thread(target=second_writer)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join(10)
+
+        # the second writer waited, so ids follow the commit order
+        self.assertEqual(commits, [1, 2])
+        with self.app.app_context():
+            changes = Change.since(0, ('actors',), 10)
+            self.assertEqual([change.resource_id for change in changes], [1, 2])
+            db.session.remove()
+
+    def test_changes_read_in_transaction_order(self):
+        # on PostgreSQL a later transaction may draw the lower id, here the
+        # delete committed before the create it undoes was read
+        actor = json.dumps({'gender': 'Female', 'age': 30})
+        with self.app.app_context():
+            db.session.add(Change(resource='actors', operation='create', resource_id=1, version=1, data=actor, txid=5))
+            db.session.add(Change(resource='actors', operation='delete', resource_id=1, version=1, txid=3))
+            db.session.commit()
+
+            changes = Change.since(0, ('actors',), 10)
+            self.assertEqual([change.operation for change in changes], ['delete', 'create'])
+            self.assertEqual([change.id for change in Change.since(2, ('actors',), 10)], [1])
+            self.assertEqual(Change.head(), 1)
+
+            # check the index does not bring the deleted actor back
+            index = ActorIndex()
+            for change in changes:
+                index.apply(change)
+            self.assertEqual(index.match(None, 0, 130, (), 10), (0, []))
+            db.session.remove()
+
+    def test_get_events_replays_after_last_event_id(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().post('/movies', json=self.new_movie_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/events', headers={"Authorization": (casting_assistant_jwt), "Last-Event-ID": "0"}, buffered=False)
+
+        # read the replayed backlog without waiting for live events
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        chunks = iter(res.response)
+        events = [chunk for chunk in (next(chunks), next(chunks), next(chunks))]
+        res.close()
+
+        self.assertIn(b'id: 1\nevent: create', events[1])
+        self.assertIn(b'"resource": "actors"', events[1])
+        self.assertIn(b'id: 2\nevent: create', events[2])
+
+    def test_get_events_resyncs_after_replay_limit(self):
+        self.app.config['EVENTS_REPLAY_LIMIT'] = 1
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().post('/actors', json=self.new_actor_2, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().get('/events', headers={"Authorization": (casting_assistant_jwt), "Last-Event-ID": "0"}, buffered=False)
+
+        # one change replayed, then the client is sent to /changes
+        chunks = list(res.response)
+        res.close()
+        self.assertEqual(len(chunks), 3)
+        self.assertIn(b'id: 1\nevent: create', chunks[1])
+        self.assertEqual(chunks[2], b'event: resync\ndata: {"since": 1}\n\n')
+
+    def test_503_get_events_over_max_streams(self):
+        self.app.config['EVENTS_MAX_STREAMS'] = 1
+        headers = {"Authorization": (casting_assistant_jwt)}
+        first = self.client().get('/events', headers=headers, buffered=False)
+        res = self.client().get('/events', headers=headers, buffered=False)
+        data = json.loads(res.data)
+
+        # check the second stream is turned away until the first closes
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '3')
+        self.assertFalse(data['success'])
+
+        first.close()
+        res = self.client().get('/events', headers=headers, buffered=False)
+        self.assertEqual(res.status_code, 200)
+        res.close()
+
+    """
+    Test API endpoint for batches
+    """
+    def test_post_batch(self):
+        batch = {'requests': [
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_1},
+            {'method': 'GET', 'path': '/actors/1'},
+            {'method': 'PATCH', 'path': '/actors/1', 'body': self.update_actor, 'headers': {'If-Match': '"1"'}},
+            {'method': 'DELETE', 'path': '/actors/1000'},
+        ]}
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        # check status and the results in order
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([response['status'] for response in data['responses']], [200, 200, 200, 404])
+        self.assertEqual(data['responses'][1]['body']['actor']['name'], 'Gal Gadot')
+        self.assertEqual(data['responses'][2]['etag'], '"2"')
+
+    def test_post_batch_checks_sub_request_permissions(self):
+        batch = {'requests': [{'method': 'POST', 'path': '/movies', 'body': self.new_movie_1}]}
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (casting_director_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['responses'][0]['status'], 401)
+
+    def test_422_post_atomic_batch_rolls_back(self):
+        batch = {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_1},
+            {'method': 'PATCH', 'path': '/actors/1000', 'body': self.update_actor},
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_2},
+        ]}
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        # the batch stops at the failing sub-request and keeps no writes
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual([response['status'] for response in data['responses']], [200, 404])
+
+        res = self.client().get('/actors', headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(len(json.loads(res.data)['actors']), 0)
+
+    def test_422_post_atomic_batch_does_not_cache_rolled_back_reads(self):
+        batch = {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_1},
+            {'method': 'GET', 'path': '/actors'},
+            {'method': 'PATCH', 'path': '/actors/1000', 'body': self.update_actor},
+        ]}
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        # the sub-request sees the batch's own write, later requests do not
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(len(data['responses'][1]['body']['actors']), 1)
+        res = self.client().get('/actors', headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(len(json.loads(res.data)['actors']), 0)
+
+    def test_post_atomic_batch_reads_are_not_coalesced(self):
+        batch = {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_1},
+            {'method': 'GET', 'path': '/actors'},
+        ]}
+        leaders = flight.stats()['leaders']
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (executive_producer_jwt)})
+
+        # the sub-request read the batch's write without leading a flight
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(flight.stats()['leaders'], leaders)
+
+    def test_422_post_atomic_batch_match_does_not_index_rolled_back_rows(self):
+        batch = {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_1},
+            {'method': 'GET', 'path': '/actors/match?gender=female&age_min=30&age_max=40'},
+            {'method': 'PATCH', 'path': '/actors/1000', 'body': self.update_actor},
+        ]}
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        # the sub-request matches the batch's own write, the index never saw it
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['responses'][1]['body']['total'], 1)
+        res = self.client().get('/actors/match?gender=female&age_min=30&age_max=40',
+                                headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(json.loads(res.data)['total'], 0)
+
+    def test_400_post_batch_checks_every_entry_first(self):
+        batch = {'requests': [
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_1},
+            {'method': 'PUT', 'path': '/actors/1', 'body': self.update_actor},
+        ]}
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (executive_producer_jwt)})
+
+        # the malformed entry is found before the POST runs
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/actors', headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(len(json.loads(res.data)['actors']), 0)
+
+    def test_400_post_batch_with_probe(self):
+        batch = {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_1},
+            {'method': 'GET', 'path': '/readyz'},
+            {'method': 'POST', 'path': '/actors', 'body': self.new_actor_2},
+        ]}
+        res = self.client().post('/batch', json=batch, headers={"Authorization": (executive_producer_jwt)})
+
+        # probes cannot be batched and the batch keeps no writes
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/actors', headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(len(json.loads(res.data)['actors']), 0)
+
+    """
+    Test API endpoint for background jobs
+    """
+    def test_post_jobs_import_actors(self):
+        job = {'kind': 'import_actors', 'payload': {'rows': [self.new_actor_1, self.new_actor_2]}}
+        res = self.client().post('/jobs', json=job, headers={"Authorization": (casting_director_jwt)})
+        data = json.loads(res.data)
+
+        # check the job is queued
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['status'], 'queued')
+
+        # run it the way a worker process would
+        with self.app.app_context():
+            self.assertTrue(run_next('test-worker'))
+
+        res = self.client().get(res.headers['Location'], headers={"Authorization": (casting_director_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertEqual(data['job']['progress'], 100)
+        self.assertEqual(data['job']['result'], {'created': [1, 2]})
+
     """
     Test Error behaviour for /actors
     """
@@ -200,6 +767,105 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    # Test actor update with a stale If-Match version
+    def test_patch_actors_without_changes(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/actors/1', json={'name': None}, headers={"Authorization": (executive_producer_jwt), "If-Match": '"1"'})
+        data = json.loads(res.data)
+
+        # check nothing was written, not even a version bump or a change
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"1"')
+        self.assertEqual(data['actor'][0]['name'], self.new_actor_1['name'])
+        res = self.client().get('/changes', headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(len(json.loads(res.data)['changes']), 1)
+
+        # the If-Match check still applies
+        res = self.client().patch('/actors/1', json={}, headers={"Authorization": (executive_producer_jwt), "If-Match": '"2"'})
+        self.assertEqual(res.status_code, 412)
+        res = self.client().patch('/actors/2', json={}, headers={"Authorization": (executive_producer_jwt)})
+        self.assertEqual(res.status_code, 404)
+
+    def test_412_patch_actors_stale_if_match(self):
+        res = self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/actors/1', json=self.update_actor, headers={"Authorization": (executive_producer_jwt), "If-Match": '"1"'})
+        res = self.client().patch('/actors/1', json=self.update_actor, headers={"Authorization": (executive_producer_jwt), "If-Match": '"1"'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'precondition failed')
+
+    # Test movie creation with a body that is not JSON
+    def test_400_post_movies_not_json(self):
+        res = self.client().post('/movies', data='title=Matrix', headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # Test actor creation with invalid fields
+    def test_422_post_actors_invalid_fields(self):
+        actor = {'name': 'Gal Gadot', 'age': 'thirty-five', 'height': 178}
+        res = self.client().post('/actors', json=actor, headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        # every invalid field is reported at once
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(sorted(error['field'] for error in data['errors']), ['age', 'gender', 'height'])
+
+    # Test movie update with an invalid release date
+    def test_422_patch_movies_invalid_release_date(self):
+        res = self.client().post('/movies', json=self.new_movie_1, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/movies/1', json={'release_date': 'next summer'}, headers={"Authorization": (executive_producer_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['field'], 'release_date')
+
+    # Test import job with an invalid row
+    def test_422_post_jobs_invalid_rows(self):
+        job = {'kind': 'import_actors', 'payload': {'rows': [self.new_actor_1, {'name': 'Daisy Ridley', 'gender': 'female', 'age': -1}]}}
+        res = self.client().post('/jobs', json=job, headers={"Authorization": (casting_director_jwt)})
+        data = json.loads(res.data)
+
+        # the job is rejected before it is queued
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['field'], 'payload.rows[1].age')
+
+    # Test actor list with an unknown count mode
+    def test_400_get_actors_count_mode(self):
+        res = self.client().get('/actors?count=all', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_400_get_actors_malformed_limit(self):
+        for query in ('limit=abc', 'limit=-5', 'after=1.5'):
+            res = self.client().get('/actors?' + query, headers={"Authorization": (casting_assistant_jwt)})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(data['success'])
+
+    # Test actor match with an inverted age band
+    def test_400_match_actors(self):
+        res = self.client().get('/actors/match?age_min=40&age_max=20', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_400_match_actors_malformed_parameters(self):
+        for query in ('age_min=abc', 'age_max=4.5', 'limit=ten', 'exclude=1,x'):
+            res = self.client().get('/actors/match?' + query, headers={"Authorization": (casting_assistant_jwt)})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(data['success'])
+
     # Test get actor without RBAC permission
     def test_401_get_actors(self):
         res = self.client().get('/actors')
@@ -249,6 +915,17 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    # Test movie update with a stale If-Match version
+    def test_412_patch_movies_stale_if_match(self):
+        res = self.client().post('/movies', json=self.new_movie_2, headers={"Authorization": (executive_producer_jwt)})
+        res = self.client().patch('/movies/1', json=self.update_movie, headers={"Authorization": (executive_producer_jwt), "If-Match": '"1"'})
+        res = self.client().patch('/movies/1', json=self.update_movie, headers={"Authorization": (executive_producer_jwt), "If-Match": '"1"'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'precondition failed')
+
     # Test get actor without RBAC permission
     def test_401_get_movies(self):
         res = self.client().get('/movies')
@@ -257,6 +934,185 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
         self.assertFalse(data['success'])
 
+    # Test change feed without a token
+    def test_400_get_changes_malformed_cursor(self):
+        res = self.client().get('/changes?since=abc', headers={"Authorization": (casting_assistant_jwt)})
+        data = json.loads(res.data)
+
+        # a malformed cursor is not read as 0, which would replay the whole log
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_401_get_changes(self):
+        res = self.client().get('/changes')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+
+    # Test job submission without the permissions of its kind
+    def test_401_post_jobs_without_permission(self):
+        job = {'kind': 'delete_movies', 'payload': {'ids': [1]}}
+        res = self.client().post('/jobs', json=job, headers={"Authorization": (casting_director_jwt)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+
+    # Test request profiling without the profile:requests permission
+    def test_401_profile_without_permission(self):
+        res = self.client().get('/movies', headers={"Authorization": (executive_producer_jwt), "X-Profile": "cprofile"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+        self.assertNotIn('X-Profile-Status', res.headers)
+
+    def profile(self, path, **headers):
+        # no test token holds profile:requests
+        headers = dict(headers, Authorization=casting_assistant_jwt)
+        with mock.patch('profiling.verified_payload', return_value={'permissions': ['profile:requests']}):
+            return self.client().get(path, headers=headers)
+
+    def test_profile_cprofile(self):
+        res = self.profile('/movies', **{"X-Profile": "cprofile"})
+
+        # check the body is pstats data for the original 200 response
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Profile-Status'], '200')
+        path = os.path.join(tempfile.mkdtemp(), 'movies.pstats')
+        with open(path, 'wb') as profile_file:
+            profile_file.write(res.data)
+        functions = pstats.Stats(path).stats
+        self.assertTrue(any(name == 'get_movies' for _, _, name in functions))
+
+    def test_profile_sample(self):
+        self.app.config['RESPONSE_CACHE_TTL'] = 0
+        page_json = Movie.page_json
+
+        def slow_page_json(*args):
+            # long enough for the sampler to see the view
+            time.sleep(0.05)
+            return page_json(*args)
+
+        with mock.patch.object(Movie, 'page_json', slow_page_json):
+            res = self.profile('/movies', **{"X-Profile": "sample"})
+
+        # check the body is collapsed stacks, "outer;inner count" per line
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        lines = res.data.decode().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            _, count = line.rsplit(' ', 1)
+            self.assertTrue(count.isdigit())
+        self.assertTrue(any('slow_page_json' in line for line in lines))
+
+    def test_profile_output_file(self):
+        self.app.config['PROFILE_DIR'] = os.path.join(tempfile.mkdtemp(), 'profiles')
+        res = self.profile('/movies', **{"X-Profile": "cprofile", "X-Profile-Output": "file"})
+        data = json.loads(res.data)
+
+        # check the response is untouched and the profile saved privately
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        path = os.path.join(self.app.config['PROFILE_DIR'], res.headers['X-Profile-File'])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertTrue(pstats.Stats(path).stats)
+
+    def test_profile_sample_every(self):
+        self.app.config['PROFILE_DIR'] = os.path.join(tempfile.mkdtemp(), 'profiles')
+        self.app.config['PROFILE_SAMPLE_EVERY'] = 2
+        responses = [self.client().get('/movies', headers={"Authorization": (casting_assistant_jwt)}) for _ in range(4)]
+
+        # check every second request of the route was profiled to a file
+        self.assertEqual([res.status_code for res in responses], [200] * 4)
+        self.assertEqual(['X-Profile-File' in res.headers for res in responses], [False, True, False, True])
+        self.assertEqual(len(os.listdir(self.app.config['PROFILE_DIR'])), 2)
+
+    def test_shared_cache_is_private(self):
+        directory = tempfile.mkdtemp()
+        private = SharedCache(os.path.join(directory, 'private.sqlite3'))
+        private.set('key', 'value', 60)
+
+        # a new file is created for the current user only
+        self.assertEqual(private.get('key'), 'value')
+        self.assertEqual(os.stat(private.path).st_mode & 0o777, 0o600)
+
+        # a file others can write is refused and every lookup misses
+        os.chmod(private.path, 0o666)
+        self.assertIsNone(SharedCache(private.path).get('key'))
+
+    def test_shared_cache_purges_expired_entries_periodically(self):
+        shared = SharedCache(os.path.join(tempfile.mkdtemp(), 'purge.sqlite3'))
+        shared.set('expired', 'value', -1)
+        shared.invalidate('movies')
+
+        def keys():
+            return [row[0] for row in shared.connection.execute('SELECT key FROM entries ORDER BY key')]
+
+        # writes no longer purge, the expired entry is only skipped
+        self.assertIsNone(shared.get('expired'))
+        self.assertEqual(keys(), ['expired'])
+
+        # once the purge interval has passed the next store deletes it
+        shared.purged_at -= 60
+        shared.set('fresh', 'value', 60)
+        self.assertEqual(keys(), ['fresh'])
+
+    def test_audit_log_records_requests(self):
+        audit_log = self.app.extensions['audit_log']
+        audit_log.path = os.path.join(tempfile.mkdtemp(), 'audit.log')
+        self.client().post('/actors', json=self.new_actor_1, headers={"Authorization": (executive_producer_jwt)})
+        self.client().delete('/actors/1')
+        audit_log.flush()
+        with open(audit_log.path) as audit_file:
+            records = [json.loads(line) for line in audit_file]
+
+        self.assertEqual([record['status'] for record in records], [200, 401])
+        self.assertIsNotNone(records[0]['sub'])
+        self.assertEqual(records[0]['route'], '/actors')
+        self.assertIsNone(records[1]['sub'])
+        self.assertEqual(records[1]['route'], '/actors/<int:id>')
+        self.assertEqual(records[1]['args'], {'id': 1})
+        self.assertEqual(audit_log.stats()['written'], 2)
+        self.assertEqual(os.stat(audit_log.path).st_mode & 0o777, 0o600)
+
+    def test_audit_log_refuses_symlink(self):
+        audit_log = self.app.extensions['audit_log']
+        directory = tempfile.mkdtemp()
+        target = os.path.join(directory, 'target')
+        open(target, 'w').close()
+        audit_log.path = os.path.join(directory, 'audit.log')
+        os.symlink(target, audit_log.path)
+        self.client().get('/actors')
+        audit_log.flush()
+
+        # the planted link is not followed, the record is dropped instead
+        self.assertEqual(os.path.getsize(target), 0)
+        self.assertEqual(audit_log.stats()['dropped'], 1)
+
+    def test_capture_strips_tokens_and_personal_data(self):
+        self.app.config['TRAFFIC_CAPTURE_PATH'] = os.path.join(tempfile.mkdtemp(), 'capture.jsonl')
+        headers = {"Authorization": (executive_producer_jwt), "Idempotency-Key": "capture-1"}
+        self.client().post('/actors', json=self.new_actor_1, headers=headers)
+        self.client().post('/batch', json={'requests': [{'method': 'GET', 'path': '/actors/1'}]},
+                           headers={"Authorization": (executive_producer_jwt)})
+        self.app.extensions['traffic_capture'].flush()
+        with open(self.app.config['TRAFFIC_CAPTURE_PATH']) as capture_file:
+            content = capture_file.read()
+        records = [json.loads(line) for line in content.splitlines()]
+
+        # the batch is captured once, without its sub-request
+        self.assertEqual([record['path'] for record in records], ['/actors', '/batch'])
+        self.assertNotIn(executive_producer_jwt.split()[1], content)
+        self.assertNotIn(self.new_actor_1['name'], content)
+        self.assertNotIn('capture-1', content)
+        self.assertEqual(records[0]['body'], {'name': {'$str': len(self.new_actor_1['name'])},
+                                              'gender': 'female', 'age': 35})
+        self.assertIn('post:actors', records[0]['auth']['permissions'])
+        self.assertEqual(records[1]['body'], {'requests': [{'method': 'GET', 'path': '/actors/1'}]})
+
     # Test movie creation without RBAC permission
     def test_401_post_movies(self):
         res = self.client().post('/movies', json=self.new_movie_2)